@@ -1,3 +1,4 @@
+import heapq
 import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
@@ -183,17 +184,37 @@ class Civilisation(object):
     def __init__(self, flag):
         self.flag = flag
         self.patches = set()
+        # the patches next to the civ that it does not own, with the number
+        # of its patches they touch; the graph is set by the simulation
+        self.frontier = {}
+        self.graph = None
 
     def add_patch(self, patch):
         self.patches.add(patch)
+        self.frontier.pop(patch, None)
+        for ngb in self.graph[patch]:
+            if ngb not in self.patches:
+                self.frontier[ngb] = self.frontier.get(ngb, 0) + 1
 
     def remove_patch(self, patch):
         self.patches.remove(patch)
+        owned_ngbs = 0
+        for ngb in self.graph[patch]:
+            if ngb in self.patches:
+                owned_ngbs += 1
+                continue
+            self.frontier[ngb] -= 1
+            if not self.frontier[ngb]:
+                del self.frontier[ngb]
+        if owned_ngbs:
+            self.frontier[patch] = owned_ngbs
 
 
 class Simulation(object):
     nr_patches = 100   # Number of patches
     c_distance = 15  # An arbitrary parameter to determine which patches are connected
+    map_size = 100  # The patches are placed on a map_size x map_size square
+    max_pairs = 2 ** 22  # Candidate pairs checked at once by radius_pairs
 
     def __init__(self, with_history=True):
         self.civs = self.create_civilisations()
@@ -201,9 +222,14 @@ class Simulation(object):
         self.patches = []
         self.history = []
         self.with_history = with_history
+        # CSR arrays of the graph when the simulation runs on arrays, see freeze
+        self.frozen = None
 
         self.graph = nx.Graph()
+        for civ in self.civs:
+            civ.graph = self.graph
         self.generate_patches_2d()
+        self.build_weight_tables()
         self.place_civs_on_map()
 
         # keep track of changes in history
@@ -219,13 +245,13 @@ class Simulation(object):
         for i, civ_pos in enumerate(civ_posistions):
             # each civ will have 3 neighboring patches
             civ_patch = self.patches[civ_pos]
-            civ_patch.status = self.civs[i].flag
-            self.civs[i].patches.add(civ_patch)
+            self.set_status(civ_patch, self.civs[i].flag)
+            self.civs[i].add_patch(civ_patch)
             for civ_ngb in self.graph[civ_patch]:
                 # choose neighbors that are not already taken
                 if civ_ngb.status != 'w':
                     continue
-                civ_ngb.status = self.civs[i].flag
+                self.set_status(civ_ngb, self.civs[i].flag)
                 self.civs[i].add_patch(civ_ngb)
                 if len(self.civs[i].patches) > 2:
                     break
@@ -236,19 +262,76 @@ class Simulation(object):
 
     def generate_patches_2d(self):
         # maybe use some Barabasi-Albert graph instead of random generation?
-        positions = np.random.uniform(high=100, size=(self.nr_patches,2))
+        positions = np.random.uniform(high=self.map_size, size=(self.nr_patches,2))
+        self.positions = positions
         # add patches to the graph
         for i in range(self.nr_patches):
             patch = self.generate_patch(label=i, pos=positions[i])
             self.graph.add_node(patch)
             self.patches.append(patch)
-        # add edges
-        for p1 in self.graph.nodes():
-            for p2 in self.graph.nodes():
-                if p1 == p2:
-                    continue
-                if self.distance_2d(p1, p2) <= self.c_distance:
-                    self.graph.add_edge(p1,p2)
+        # add edges, in the order of the labels so every patch gets its
+        # neighbors sorted by label, as when comparing all the pairs
+        first, second = self.radius_pairs(positions, self.c_distance)
+        self.graph.add_edges_from(
+            (self.patches[i], self.patches[j])
+            for i, j in zip(first.tolist(), second.tolist()))
+
+    def radius_pairs(self, positions, distance, strict=False):
+        # pairs (i, j), i < j, of the positions within distance (closer than
+        # distance with strict) sorted by i and j, with the same check as
+        # distance_2d. The positions are hashed on a grid with cells a bit
+        # bigger than distance, so a point is only compared with the points
+        # of its cell and of the neighboring cells.
+        nr_points = len(positions)
+        empty = np.zeros(0, dtype=np.int64)
+        if nr_points < 2 or distance < 0:
+            return empty, empty
+        size = max(distance, 1e-9) * (1 + 1e-9)
+        cells = np.floor(positions / size).astype(np.int64)
+        cells -= cells.min(axis=0)
+        width = cells[:, 0].max() + 3
+        keys = cells[:, 1] * width + cells[:, 0] + 1
+        order = np.argsort(keys, kind='mergesort')
+        sorted_keys = keys[order]
+        # the points of a cell are next to each other in memory
+        xs = positions[order, 0]
+        ys = positions[order, 1]
+        firsts, seconds = [], []
+        # every pair of neighboring cells is looked at once
+        for dx, dy in ((0, 0), (1, 0), (-1, 1), (0, 1), (1, 1)):
+            targets = sorted_keys + dy * width + dx
+            ends = np.searchsorted(sorted_keys, targets, side='right')
+            if (dx, dy) == (0, 0):
+                # the points after this one in its own cell
+                starts = np.arange(1, nr_points + 1)
+            else:
+                starts = np.searchsorted(sorted_keys, targets, side='left')
+            counts = np.maximum(ends - starts, 0)
+            totals = np.cumsum(counts)
+            lo = 0
+            while lo < nr_points:
+                # the points whose candidates fit in max_pairs
+                hi = np.searchsorted(totals, totals[lo] - counts[lo] + self.max_pairs,
+                                     side='right')
+                hi = min(max(hi, lo + 1), nr_points)
+                block = counts[lo:hi]
+                nr_pairs = block.sum()
+                if nr_pairs:
+                    rows = np.repeat(np.arange(lo, hi), block)
+                    shift = np.repeat(np.cumsum(block) - block, block)
+                    cols = starts[rows] + np.arange(nr_pairs) - shift
+                    dist = np.sqrt((ys[rows] - ys[cols])**2 +
+                                   (xs[rows] - xs[cols])**2)
+                    close = dist < distance if strict else dist <= distance
+                    a = order[rows[close]]
+                    b = order[cols[close]]
+                    firsts.append(np.minimum(a, b))
+                    seconds.append(np.maximum(a, b))
+                lo = hi
+        if not firsts:
+            return empty, empty
+        pairs = np.sort(np.concatenate(firsts) * nr_points + np.concatenate(seconds))
+        return pairs // nr_points, pairs % nr_points
 
     def distance_2d(self, p1, p2):
         return np.sqrt((p1.pos[1]-p2.pos[1])**2+(p1.pos[0]-p2.pos[0])**2)
@@ -257,33 +340,26 @@ class Simulation(object):
         return Patch(label=label, pos=pos)
 
     def run_simulation(self, steps=1):
+        if self.frozen is not None:
+            return self.run_simulation_arrays(steps)
         for step in range(steps):
             # do actions for each civ
             for civ in self.civs:
                 # for each node a civ will try to expand to the neighbors
                 # at each step only one attempt to conquer a patch can be made
-                attempts = set()
                 conquered = set()
-                for patch in civ.patches:
-                    for neighbor in self.graph[patch]:
-                        # make sure this civ doesn't own the patch already
-                        if neighbor.status == civ.flag:
-                            continue
-                        # an attempt was already made this turn
-                        if neighbor in attempts:
-                            continue
-                        # try to conquer the patch
-                        result = self.conquer(neighbor, civ)
-                        attempts.add(neighbor)
-                        if result:
-                            if neighbor.status != 'w':
-                                # the patch belongs to another civ
-                                other_civ = self.get_civ_by_color(neighbor.status)
-                                other_civ.remove_patch(neighbor)
-                            conquered.add(neighbor)
+                for neighbor in civ.frontier:
+                    # try to conquer the patch
+                    result = self.conquer(neighbor, civ)
+                    if result:
+                        if neighbor.status != 'w':
+                            # the patch belongs to another civ
+                            other_civ = self.get_civ_by_color(neighbor.status)
+                            other_civ.remove_patch(neighbor)
+                        conquered.add(neighbor)
                 # claim conquered patches
                 for patch in conquered:
-                    patch.status = civ.flag
+                    self.set_status(patch, civ.flag)
                     civ.add_patch(patch)
 
             if self.with_history:
@@ -292,13 +368,133 @@ class Simulation(object):
 
     def conquer(self, patch, civ):
         # total number of neighbors plus the node itself
-        total = len(self.graph[patch]) + 1
+        total = self.total_weight[patch.label]
         # number of neighbors belonging to this civ
-        civ_ngbs = len([ngb for ngb in self.graph[patch]
-                        if ngb.status == civ.flag])
+        civ_ngbs = self.civ_weight[patch.label].get(civ.flag, 0)
         # random component
         return bool(np.random.binomial(1, float(civ_ngbs)/total))
 
+    def build_weight_tables(self):
+        # per patch label: the weight of its neighbors plus its own, which
+        # never changes, and the weight of its neighbors owned by each civ,
+        # kept up to date by set_status
+        self.total_weight = [0] * len(self.patches)
+        self.civ_weight = [{} for patch in self.patches]
+        for patch in self.patches:
+            self.total_weight[patch.label] = self.patch_weight(patch) + sum(
+                self.patch_weight(ngb) for ngb in self.graph[patch])
+            if patch.status != 'w':
+                for ngb in self.graph[patch]:
+                    weights = self.civ_weight[ngb.label]
+                    weights[patch.status] = (weights.get(patch.status, 0) +
+                                             self.patch_weight(patch))
+
+    def set_status(self, patch, flag):
+        # every change of owner goes through here to keep the tables right
+        if patch.status == flag:
+            return
+        weight = self.patch_weight(patch)
+        for ngb in self.graph[patch]:
+            weights = self.civ_weight[ngb.label]
+            if patch.status != 'w':
+                weights[patch.status] -= weight
+            if flag != 'w':
+                weights[flag] = weights.get(flag, 0) + weight
+        patch.status = flag
+
+    def patch_weight(self, patch):
+        # weight of a patch in conquer
+        return 1
+
+    def freeze(self):
+        # run the simulation on arrays: the graph becomes CSR arrays (the
+        # neighbors of label i are indices[indptr[i]:indptr[i + 1]]), the
+        # owners an int8 vector (0 is free, k + 1 is self.civs[k]), the
+        # weights a float vector and the weight tables of conquer a matrix,
+        # row k + 1 for self.civs[k]. While frozen only the arrays change,
+        # the patches and the civs are brought up to date by unfreeze.
+        # Call it again if the graph changes.
+        if type(self).run_simulation != Simulation.run_simulation:
+            raise Exception('Only the rules of Simulation.run_simulation run on arrays')
+        if self.frozen is not None:
+            self.unfreeze()
+        nr_patches = len(self.patches)
+        degree = np.array([len(self.graph[patch]) for patch in self.patches],
+                          dtype=np.int64)
+        indptr = np.zeros(nr_patches + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(degree)
+        indices = np.fromiter((ngb.label for patch in self.patches
+                               for ngb in self.graph[patch]),
+                              dtype=np.int64, count=indptr[-1])
+        weight = np.array([self.patch_weight(patch) for patch in self.patches],
+                          dtype=np.float64)
+        flags = dict((civ.flag, k + 1) for k, civ in enumerate(self.civs))
+        owner = np.array([flags.get(patch.status, 0) for patch in self.patches],
+                         dtype=np.int8)
+        total = np.array(self.total_weight, dtype=np.float64)
+        civ_sum = np.zeros((len(self.civs) + 1, nr_patches), dtype=np.float64)
+        for label, weights in enumerate(self.civ_weight):
+            for flag, civ_weight in weights.items():
+                civ_sum[flags[flag], label] = civ_weight
+        # the history counts len(civ.patches), which can be off from the
+        # owners when civs start on the same patches
+        counts = np.bincount(owner, minlength=len(self.civs) + 1)
+        sizes = np.array([0] + [len(civ.patches) for civ in self.civs]) - counts
+        self.frozen = {'indptr': indptr, 'indices': indices, 'weight': weight,
+                       'owner': owner, 'total': total, 'civ_sum': civ_sum,
+                       'synced': owner.copy(), 'sizes': sizes}
+
+    def unfreeze(self):
+        # the patches that changed owner while frozen are handed over
+        frozen = self.frozen
+        if frozen is None:
+            return
+        self.frozen = None
+        owner = frozen['owner']
+        for label in np.flatnonzero(owner != frozen['synced']).tolist():
+            patch = self.patches[label]
+            if patch.status != 'w':
+                self.get_civ_by_color(patch.status).remove_patch(patch)
+            civ = self.civs[owner[label] - 1]
+            self.set_status(patch, civ.flag)
+            civ.add_patch(patch)
+
+    def run_simulation_arrays(self, steps=1):
+        # same rules as run_simulation: every civ makes one attempt on each
+        # patch next to it with the probability of conquer, resolved with
+        # one Bernoulli draw per attempt; like set_status the weight tables
+        # are only updated around the conquered patches
+        frozen = self.frozen
+        indptr = frozen['indptr']
+        indices = frozen['indices']
+        weight = frozen['weight']
+        owner = frozen['owner']
+        total = frozen['total']
+        civ_sum = frozen['civ_sum']
+        for step in range(steps):
+            for k in range(len(self.civs)):
+                attempts = np.flatnonzero((civ_sum[k + 1] > 0) & (owner != k + 1))
+                draws = np.random.binomial(1, civ_sum[k + 1, attempts] /
+                                           total[attempts])
+                conquered = attempts[draws.astype(bool)]
+                # the neighbors of the conquered patches, from the CSR rows
+                starts = indptr[conquered]
+                degree = indptr[conquered + 1] - starts
+                shift = np.repeat(np.cumsum(degree) - degree - starts, degree)
+                targets = indices[np.arange(degree.sum()) - shift]
+                moved = np.repeat(weight[conquered], degree)
+                np.subtract.at(civ_sum, (np.repeat(owner[conquered], degree),
+                                         targets), moved)
+                np.add.at(civ_sum[k + 1], targets, moved)
+                owner[conquered] = k + 1
+
+            if self.with_history:
+                counts = np.bincount(owner, minlength=len(self.civs) + 1)
+                counts += frozen['sizes']
+                self.history.append(dict((civ.flag, int(counts[k + 1]))
+                                         for k, civ in enumerate(self.civs)))
+            self.step += 1
+
     def get_civ_by_color(self, color):
         for civ in self.civs:
             if civ.flag == color:
@@ -329,15 +525,9 @@ class Simulation(object):
 class CivilisationRandomStrategy(Civilisation):
     def run_strategy(self, graph):
         ''' Will select a random subset of nodes from the neighbors.'''
-        neighbors = set()
-        for patch in self.patches:
-            for neighbor in graph[patch]:
-                if neighbor in self.patches:
-                    continue
-                neighbors.add(neighbor)
-        if not neighbors:
+        if not self.frontier:
             return []
-        return random.choice(list(neighbors), len(self.patches)/3 or 1)
+        return random.choice(list(self.frontier), len(self.patches)/3 or 1)
 
 
 class CivilisationNaiveStrategy(Civilisation):
@@ -349,22 +539,14 @@ class CivilisationNaiveStrategy(Civilisation):
         return self.neighbors_move(neighbors)
 
     def neighbors_move(self, neighbors):
-        move = neighbors.items()
-        # sort the orders by the number of connections it has with the civ
-        move.sort(key=lambda x: -x[1])
-        return [node for (node, connex) in move[:len(self.patches)/3 or 1]]
+        # the orders with the most connections with the civ
+        move = heapq.nlargest(len(self.patches)/3 or 1, neighbors.items(),
+                              key=lambda x: x[1])
+        return [node for (node, connex) in move]
 
     def get_neighbors(self, graph):
-        neighbors = {}
-        for patch in self.patches:
-            for neighbor in graph[patch]:
-                if neighbor in self.patches:
-                    continue
-                if neighbor in neighbors:
-                    neighbors[neighbor] += 1
-                else:
-                    neighbors[neighbor] = 1
-        return neighbors
+        # the frontier, it is kept up to date by add_patch and remove_patch
+        return self.frontier
 
 
 class CivilisationAggressiveStrategy(CivilisationNaiveStrategy):
@@ -469,7 +651,7 @@ class SimulationRandomStrategy(Simulation):
                         conquered.add(patch)
                 # claim conquered patches
                 for patch in conquered:
-                    patch.status = civ.flag
+                    self.set_status(patch, civ.flag)
                     civ.add_patch(patch)
 
             if self.with_history:
@@ -525,16 +707,25 @@ class SimulationComplexStrategy(SimulationNaiveStrategy):
         self.add_weights_to_patches()
 
     def extend_edges(self):
-        components = [comp for comp in nx.connected_components(self.graph)]
-        if len(components) > 1:
-            for i in range(len(components) - 1):
-                for j in range(1, len(components)):
-                    comp_1 = components[i]
-                    comp_2 = components[j]
-                    for patch_1 in comp_1:
-                        for patch_2 in comp_2:
-                            if self.distance_2d(patch_1, patch_2) < self.c_distance_extended:
-                                self.graph.add_edge(patch_1, patch_2)
+        # link all the patches of different components that are closer than
+        # c_distance_extended, the components are the ones found before any
+        # link is added
+        self.find_components()
+        if self.nr_components < 2:
+            return
+        first, second = self.radius_pairs(self.positions, self.c_distance_extended,
+                                          strict=True)
+        bridges = self.component_of[first] != self.component_of[second]
+        for i, j in zip(first[bridges].tolist(), second[bridges].tolist()):
+            self.graph.add_edge(self.patches[i], self.patches[j])
+
+    def find_components(self):
+        # component id of every patch label
+        self.component_of = np.zeros(len(self.patches), dtype=np.int64)
+        self.nr_components = 0
+        for comp_id, comp in enumerate(nx.connected_components(self.graph)):
+            self.component_of[[patch.label for patch in comp]] = comp_id
+            self.nr_components += 1
 
     def add_weights_to_patches(self):
         # max 5% of the nodes will be big cities
@@ -566,14 +757,15 @@ class SimulationComplexStrategy(SimulationNaiveStrategy):
 
     def conquer(self, patch, civ):
         # total sum of weights of the neighbors plus the weight of the node itself
-        total_sum = sum([neighbor.weight for neighbor in self.graph[patch]])
-        total_sum += patch.weight
+        total_sum = self.total_weight[patch.label]
         # sum of weigths of the neighbors belonging to this civ
-        civ_sum = sum([ngb.weight for ngb in self.graph[patch]
-                                if ngb.status == civ.flag])
+        civ_sum = self.civ_weight[patch.label].get(civ.flag, 0)
         # random component
         return bool(np.random.binomial(1, float(civ_sum)/total_sum))
 
+    def patch_weight(self, patch):
+        return patch.weight
+
     def neighborhood(self, node, n):
         path_lengths = self._path_lengths.get(node)
         if not path_lengths:
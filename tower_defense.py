@@ -1,5 +1,24 @@
+import bisect
+import hashlib
 import re
 import time
+from array import array
+from collections import OrderedDict, deque
+
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+
+try:
+    from sys import intern
+except ImportError:
+    pass
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 class Position(object):
@@ -25,7 +44,11 @@ class Bug(object):
         self.id = id
         self.colors = {}
         self.frame = None
-        self.position = None
+        # the bug is on the map when it has an offset along its road
+        self.road = None
+        self.offset = None
+        # plain position of a bug that is not placed on a road
+        self._position = None
         self.dead = False
         self.finished = False
 
@@ -41,6 +64,32 @@ class Bug(object):
     def set_position(self, x, y):
         self.position = Position(x, y)
 
+    def place(self, road, offset):
+        self.road = road
+        self.offset = offset
+
+    @property
+    def position(self):
+        if self.road is None:
+            return self._position
+        if self.offset is None:
+            return None
+        return self.road[self.offset]
+
+    @position.setter
+    def position(self, pos):
+        # slow path kept for compatibility, the engine works with offsets;
+        # before place() the position is only stored
+        if self.road is None:
+            self._position = pos
+        elif pos is None:
+            self.offset = None
+        elif pos in self.road:
+            self.offset = self.road.index(pos)
+        else:
+            raise Exception('Position %s is not on the road of bug %s' % (
+                pos, self.id))
+
     def check_dead(self):
         dead = True
         for value in self.colors.values():
@@ -56,11 +105,289 @@ class Bug(object):
         return self.__str__()
 
 
+class BugStore(Mapping):
+    # struct-of-arrays bug population: one row per bug, one column per color;
+    # behaves like the {bug_id: bug} dict of the bugs that were not cleared.
+    # The rows are sorted by spawn frame and all the bugs walk at the same
+    # speed, so the bugs on the map are the rows between lo and hi: the ones
+    # before lo have left the game and the ones from hi on did not spawn yet.
+    # present tells which colors every bug has, all of them when None; the
+    # health of a color a bug does not have stays 0
+    def __init__(self, ids, colors, health, frame, road, present=None):
+        if np is None:
+            raise Exception('numpy is required for the vectorized bug store')
+        self.road = road
+        frame = np.asarray(frame, dtype=np.int64)
+        order = np.argsort(frame, kind='stable')
+        self.ids = [ids[i] for i in order]
+        self.index = dict((bug_id, i) for i, bug_id in enumerate(self.ids))
+        self.colors = colors
+        self.color_index = dict((c, i) for i, c in enumerate(self.colors))
+
+        # health is played on, so it is always copied
+        self.health = np.array(health, dtype=np.int64)[order]
+        if present is None:
+            self.present = np.ones(self.health.shape, dtype=bool)
+        else:
+            self.present = np.asarray(present, dtype=bool).reshape(
+                self.health.shape)[order]
+        self.frame = frame[order]
+        # -1 means the bug is not on the map
+        self.offset = np.full(len(ids), -1, dtype=np.int64)
+        # alive: not cleared from the game yet
+        self.alive = np.ones(len(ids), dtype=bool)
+        # dead and finished are only kept up to date between lo and hi
+        self.dead = np.zeros(len(ids), dtype=bool)
+        self.finished = np.zeros(len(ids), dtype=bool)
+        self.lo = 0
+        self.hi = 0
+        # bugs that were not cleared
+        self.remaining = len(ids)
+        # waiting bugs without health or with a negative one, the first
+        # frame kills them or turns the negative health into damage
+        self.pending = np.flatnonzero((self.frame > 0) &
+                                      (np.all(self.health <= 0, axis=1) |
+                                       np.any(self.health < 0, axis=1)))
+
+    @classmethod
+    def from_bugs(cls, bugs, road):
+        if np is None:
+            raise Exception('numpy is required for the vectorized bug store')
+        bugs = list(bugs)
+        colors = set()
+        for bug in bugs:
+            colors.update(bug.colors)
+        colors = sorted(colors)
+        color_index = dict((c, i) for i, c in enumerate(colors))
+        health = np.zeros((len(bugs), len(colors)), dtype=np.int64)
+        present = np.zeros(health.shape, dtype=bool)
+        for i, bug in enumerate(bugs):
+            for color, value in bug.colors.items():
+                health[i, color_index[color]] = value
+                present[i, color_index[color]] = True
+        frame = [bug.frame for bug in bugs]
+        return cls([bug.id for bug in bugs], colors, health, frame, road,
+                   present)
+
+    def __getitem__(self, bug_id):
+        i = self.index[bug_id]
+        if not self.alive[i]:
+            raise KeyError(bug_id)
+        return BugView(self, i)
+
+    def __iter__(self):
+        for i in np.flatnonzero(self.alive):
+            yield self.ids[i]
+
+    def __len__(self):
+        return self.remaining
+
+    def __contains__(self, bug_id):
+        i = self.index.get(bug_id)
+        return i is not None and bool(self.alive[i])
+
+    def bug_colors(self, i):
+        # {color: health} of row i, only the colors the bug has
+        return dict((color, int(value)) for color, value, has in
+                    zip(self.colors, self.health[i], self.present[i]) if has)
+
+    def active(self):
+        # number of bugs on the map
+        return int(np.count_nonzero(self.alive[self.lo:self.hi]))
+
+    def put_on_map(self, frame):
+        hi = int(np.searchsorted(self.frame, frame, side='right'))
+        self.offset[self.hi:hi] = 0
+        self.hi = hi
+
+    def move(self):
+        lo, hi = self.lo, self.hi
+        last = len(self.road) - 1
+        offset = self.offset[lo:hi]
+        np.minimum(offset + 1, last, out=offset)
+        self.finished[lo:hi] = offset == last
+
+    def check_dead(self):
+        lo, hi = self.lo, self.hi
+        self.dead[lo:hi] = self.alive[lo:hi] & np.all(self.health[lo:hi] <= 0,
+                                                      axis=1)
+        if len(self.pending):
+            self.dead[self.pending] = np.all(self.health[self.pending] <= 0,
+                                             axis=1)
+
+    def compute_damage(self):
+        lo, hi = self.lo, self.hi
+        alive = self.alive[lo:hi]
+        rows = self.health[lo:hi]
+        # direct damage from the bugs that finished the road
+        finished = self.finished[lo:hi] & alive
+        damage = int(np.clip(rows[finished], 0, None).sum())
+        # collateral damage
+        damage -= int(np.clip(rows[alive], None, 0).sum())
+        np.clip(rows, 0, None, out=rows, where=alive[:, None])
+        if len(self.pending):
+            pending = self.health[self.pending]
+            damage -= int(np.clip(pending, None, 0).sum())
+            self.health[self.pending] = np.clip(pending, 0, None)
+        return damage
+
+    def count_dead(self):
+        dead = int(np.count_nonzero(self.dead[self.lo:self.hi]))
+        if len(self.pending):
+            dead += int(np.count_nonzero(self.dead[self.pending]))
+        return dead
+
+    def clear(self):
+        # removes the dead bugs and retires the ones that finished the road,
+        # returns how many bugs escaped
+        lo, hi = self.lo, self.hi
+        alive = self.alive[lo:hi]
+        escaped = int(np.count_nonzero(alive & self.finished[lo:hi] &
+                                       ~self.dead[lo:hi]))
+        self.remaining -= int(np.count_nonzero(alive & (self.dead[lo:hi] |
+                                                        self.finished[lo:hi])))
+        alive &= ~(self.dead[lo:hi] | self.finished[lo:hi])
+        if len(self.pending):
+            dead = self.pending[self.dead[self.pending]]
+            self.alive[dead] = False
+            self.dead[self.pending] = False
+            self.remaining -= len(dead)
+            self.pending = self.pending[:0]
+        # the window starts at the oldest bug still on the map
+        if alive.any():
+            self.lo = lo + int(np.argmax(alive))
+        else:
+            self.lo = hi
+        return escaped
+
+    def snapshot(self):
+        return (self.health.copy(), self.offset.copy(), self.alive.copy(),
+                self.dead.copy(), self.finished.copy(), self.lo, self.hi,
+                self.remaining, self.pending)
+
+    def restore(self, snap):
+        (health, offset, alive, dead, finished, lo, hi, remaining,
+         self.pending) = snap
+        self.health[...] = health
+        self.offset[...] = offset
+        self.alive[...] = alive
+        self.dead[...] = dead
+        self.finished[...] = finished
+        self.lo = lo
+        self.hi = hi
+        self.remaining = remaining
+
+
+class BugColorsView(MutableMapping):
+    # the colors of a bug in a BugStore, the ones it does not have are left
+    # out like in the dict of a Bug
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def _column(self, color):
+        c = self.store.color_index.get(color)
+        if c is None or not self.store.present[self.index, c]:
+            raise KeyError(color)
+        return c
+
+    def __getitem__(self, color):
+        return int(self.store.health[self.index, self._column(color)])
+
+    def __setitem__(self, color, value):
+        self.store.health[self.index, self._column(color)] = value
+
+    def __delitem__(self, color):
+        raise TypeError('bug colors can not be removed')
+
+    def __iter__(self):
+        present = self.store.present[self.index]
+        return iter([color for c, color in enumerate(self.store.colors)
+                     if present[c]])
+
+    def __len__(self):
+        return int(np.count_nonzero(self.store.present[self.index]))
+
+    def __str__(self):
+        return str(dict(self))
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class BugView(object):
+    # lightweight Bug compatible view on a row of a BugStore
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def id(self):
+        return self.store.ids[self.index]
+
+    @property
+    def colors(self):
+        return BugColorsView(self.store, self.index)
+
+    @property
+    def frame(self):
+        return int(self.store.frame[self.index])
+
+    @property
+    def road(self):
+        return self.store.road
+
+    @property
+    def offset(self):
+        offset = int(self.store.offset[self.index])
+        if offset < 0:
+            return None
+        return offset
+
+    @offset.setter
+    def offset(self, offset):
+        self.store.offset[self.index] = -1 if offset is None else offset
+
+    @property
+    def position(self):
+        offset = self.offset
+        if offset is None:
+            return None
+        return self.store.road[offset]
+
+    @property
+    def dead(self):
+        return bool(self.store.dead[self.index])
+
+    @property
+    def finished(self):
+        return bool(self.store.finished[self.index])
+
+    def check_dead(self):
+        self.store.dead[self.index] = all(
+            value <= 0 for value in self.colors.values())
+
+    def __str__(self):
+        return '%s - %s - %s' % (self.id, self.colors, self.frame)
+
+    def __repr__(self):
+        return self.__str__()
+
+
 class Tower(object):
     def __init__(self, id):
         self.id = id
         self.colors = {}
         self.position = None
+        # sorted bug road offsets in range of the tower and the same offsets
+        # as (start, end) intervals for the range checks
+        self.road_offsets = []
+        self.road_starts = []
+        self.road_ends = []
 
     def set_colors(self, colors_str):
         for color_str in colors_str.split(','):
@@ -73,6 +400,30 @@ class Tower(object):
         y = int(pos_str.split(',')[1])
         self.position = Position(x, y)
 
+    def cover_road(self, road_offsets, tower_range):
+        offsets = []
+        for y in range(self.position.y - tower_range,
+                       self.position.y + tower_range + 1):
+            for x in range(self.position.x - tower_range,
+                           self.position.x + tower_range + 1):
+                offset = road_offsets.get((x, y))
+                if offset is not None:
+                    offsets.append(offset)
+        offsets.sort()
+        self.road_offsets = offsets
+        self.road_starts = []
+        self.road_ends = []
+        for offset in offsets:
+            if self.road_ends and self.road_ends[-1] + 1 == offset:
+                self.road_ends[-1] = offset
+            else:
+                self.road_starts.append(offset)
+                self.road_ends.append(offset)
+
+    def covers(self, offset):
+        i = bisect.bisect_right(self.road_starts, offset) - 1
+        return i >= 0 and offset <= self.road_ends[i]
+
     def __str__(self):
         return '%s - %s - %s' % (self.id, self.colors, self.position)
 
@@ -80,33 +431,194 @@ class Tower(object):
         return self.__str__()
 
 
-class Map(object):
+class RoadField(object):
+    # BFS distance to the nearest exit for every cell of a grid (-1 where the
+    # bugs can't walk) and the next cell a bug takes from each road cell;
+    # cells are indexed as y * cols + x
+    # cell kinds, the bugs walk on all but BLOCKED
+    BLOCKED, ROAD, ENTRANCE, EXIT = range(4)
+
+    # computed fields by map content hash, the least recently used ones are
+    # dropped past CACHE_SIZE
+    cache = OrderedDict()
+    CACHE_SIZE = 16
+
     def __init__(self, rows):
-        self.rows = rows
-        self.start, self.end = self.find_start_end()
-        self.bug_road = self.find_bug_road()
+        self.nr_rows = len(rows)
+        self.nr_cols = len(rows[0]) if rows else 0
+        cols = self.nr_cols
+        size = self.nr_rows * cols
+        self.distance = array('i', [-1]) * size
+        self.next_cell = array('i', [-1]) * size
+        self.kind = bytearray(size)
+        exits = []
+        # entrances in reading order
+        self.starts = []
+        for y, row in enumerate(rows):
+            for x, val in enumerate(row[:cols]):
+                if val == '1':
+                    self.kind[y * cols + x] = self.ROAD
+                elif val == 'E':
+                    self.kind[y * cols + x] = self.ENTRANCE
+                    self.starts.append(Position(x, y))
+                elif val == 'X':
+                    self.kind[y * cols + x] = self.EXIT
+                    exits.append(y * cols + x)
+        self.ends = [self.position(cell) for cell in exits]
+
+        queue = deque(exits)
+        for cell in exits:
+            self.distance[cell] = 0
+        while queue:
+            cell = queue.popleft()
+            dist = self.distance[cell] + 1
+            for neighbor in self.neighbors(cell):
+                if self.kind[neighbor] and self.distance[neighbor] == -1:
+                    self.distance[neighbor] = dist
+                    queue.append(neighbor)
+
+        for cell in range(size):
+            dist = self.distance[cell]
+            if dist <= 0:
+                continue
+            # same preference as the old corridor walk: x+1, x-1, y+1, y-1
+            for neighbor in self.neighbors(cell):
+                if self.distance[neighbor] == dist - 1:
+                    self.next_cell[cell] = neighbor
+                    break
+
+        # the primary entrance is the last one, as in Map.find_start_end, and
+        # keeps the corridor walk; it is the only road the map needs
+        self.primary_road = None
+        if self.starts:
+            self.primary_road = self.corridor(self.starts[-1])
+        self._roads = None
+
+    @classmethod
+    def for_rows(cls, rows):
+        key = hashlib.sha1('\n'.join(
+            ' '.join(row) for row in rows).encode('utf-8')).hexdigest()
+        field = cls.cache.pop(key, None)
+        if field is None:
+            field = cls(rows)
+        cls.cache[key] = field
+        while len(cls.cache) > cls.CACHE_SIZE:
+            cls.cache.popitem(last=False)
+        return field
+
+    @property
+    def roads(self):
+        # one road for every entrance, None for an entrance without a way to
+        # an exit; the other entrances follow the field and are only walked
+        # when asked for
+        if self._roads is None:
+            self._roads = [self.road_from(start) for start in self.starts[:-1]]
+            self._roads.append(self.primary_road)
+        return self._roads
+
+    def road_from(self, start):
+        if self.distance[start.y * self.nr_cols + start.x] == -1:
+            return None
+        return self.walk(start)
+
+    def neighbors(self, cell):
+        cols = self.nr_cols
+        y, x = divmod(cell, cols)
+        if x + 1 < cols:
+            yield cell + 1
+        if x > 0:
+            yield cell - 1
+        if y + 1 < self.nr_rows:
+            yield cell + cols
+        if y > 0:
+            yield cell - cols
+
+    def position(self, cell):
+        y, x = divmod(cell, self.nr_cols)
+        return Position(x, y)
 
-    def find_bug_road(self):
-        pos = self.start
-        road = [pos]
-        visited = set([(pos.x, pos.y)])
-        while pos != self.end:
-            pos = self._next_bug_step(pos, visited)
-            visited.add((pos.x, pos.y))
-            if not next:
-                raise Exception('Something wrong with the bug road')
-            road.append(pos)
+    def walk(self, start):
+        cell = start.y * self.nr_cols + start.x
+        if self.distance[cell] == -1:
+            raise Exception('Something wrong with the bug road: no way '
+                            'from %s to an exit' % (start,))
+        road = [start]
+        while self.distance[cell] > 0:
+            cell = self.next_cell[cell]
+            road.append(self.position(cell))
+        return road
+
+    def corridor(self, start):
+        # the walk of the original engine: from the entrance step to the
+        # first exit or unvisited road cell in the x+1, x-1, y+1, y-1 order
+        # until an exit, so a corridor that touches itself is still walked
+        # cell by cell. When a fork leads it into a dead end the road is the
+        # shortest way out instead.
+        kind = self.kind
+        cell = start.y * self.nr_cols + start.x
+        visited = set([cell])
+        road = [start]
+        while kind[cell] != self.EXIT:
+            for neighbor in self.neighbors(cell):
+                if kind[neighbor] == self.EXIT or (
+                        kind[neighbor] == self.ROAD and neighbor not in visited):
+                    break
+            else:
+                return self.walk(start)
+            cell = neighbor
+            visited.add(cell)
+            road.append(self.position(cell))
         return road
 
-    def _next_bug_step(self, pos, visited):
-        neighbors = self.get_neighbors(pos)
-        for neighbor in neighbors:
-            if self.get_pos_value(neighbor.x, neighbor.y) == 'X':
-                return neighbor
-            if self.get_pos_value(neighbor.x, neighbor.y) == '1' and\
-                (neighbor.x, neighbor.y) not in visited:
-                    return neighbor
-        return None
+
+class Map(object):
+    def __init__(self, rows, bug_road=None):
+        self.rows = rows
+        self._field = None
+        if bug_road:
+            # an already computed road, no need to walk the grid again
+            self.start, self.end = bug_road[0], bug_road[-1]
+            self.bug_road = bug_road
+        else:
+            self.start, self.end = self.find_start_end()
+            self.bug_road = self.find_bug_road()
+        self.road_offsets = dict(((pos.x, pos.y), offset)
+                                 for offset, pos in enumerate(self.bug_road))
+
+    @property
+    def field(self):
+        if self._field is None:
+            self._field = RoadField.for_rows(self.rows)
+        return self._field
+
+    @property
+    def distance(self):
+        # distance to the exit of every cell, see RoadField
+        return self.field.distance
+
+    @property
+    def starts(self):
+        return self.field.starts
+
+    @property
+    def roads(self):
+        # one road for every entrance in the order of Map.starts, None for
+        # the ones that do not reach an exit
+        return self.field.roads
+
+    def find_bug_road(self):
+        if self.start is None or self.end is None:
+            raise Exception('Something wrong with the bug road: the map '
+                            'needs an entrance (E) and an exit (X)')
+        return list(self.field.primary_road)
+
+    def next_bug_step(self, pos):
+        # the next cell on the shortest way to an exit, None at the exit
+        field = self.field
+        cell = field.next_cell[pos.y * field.nr_cols + pos.x]
+        if cell == -1:
+            return None
+        return field.position(cell)
 
     def check_tower_pos(self, x, y):
         pos_value = self.get_pos_value(x, y)
@@ -205,6 +717,10 @@ class Map(object):
         return self.__str__()
 
 
+class ActionSyntaxError(Exception):
+    pass
+
+
 class Action(object):
     NEW_TOWER = 'new_tower'
     SHOOT = 'shoot'
@@ -213,6 +729,46 @@ class Action(object):
         self.action_type = action_type
         self.frame = frame
         self.attrs = attrs
+        # typed attributes, so nothing is parsed while the game runs
+        self.tower_id = None
+        self.bug_id = None
+        self.position = None
+        self.colors = None
+        self.compile()
+
+    def compile(self):
+        try:
+            if self.action_type == self.NEW_TOWER:
+                self.tower_id = intern(self.attrs['name'])
+                x, y = self.attrs['position'].split(',')
+                self.position = (int(x), int(y))
+                self.colors = {}
+                for color_str in self.attrs['colors'].split(','):
+                    name, val = color_str.split(':')
+                    self.colors[intern(name)] = int(val)
+            elif self.action_type == self.SHOOT:
+                self.tower_id = intern(self.attrs['tower_name'])
+                self.bug_id = intern(self.attrs['bug_name'])
+        except (KeyError, ValueError) as e:
+            raise ActionSyntaxError('Invalid %s action at frame %s: %s' % (
+                self.action_type, self.frame, e))
+
+    @classmethod
+    def new_tower(cls, frame, tower_id, position, colors):
+        x = position[0]
+        y = position[1]
+        attrs = {
+            'name': tower_id,
+            'position': ','.join([str(x),str(y)]),
+            'colors': ','.join(['%s:%s' % (name, val)
+                                for name, val in colors.items()])
+        }
+        return cls(cls.NEW_TOWER, frame, attrs)
+
+    @classmethod
+    def shoot(cls, frame, tower_id, bug_id):
+        attrs = {'tower_name': tower_id, 'bug_name': bug_id}
+        return cls(cls.SHOOT, frame, attrs)
 
     def __str__(self):
         return '%s - %s - %s' % (self.action_type, self.attrs, self.frame)
@@ -221,25 +777,240 @@ class Action(object):
         return self.__str__()
 
 
+def group_by_frame(actions):
+    # {frame: [actions of the frame]} in the order of the actions
+    frames = {}
+    for action in actions:
+        frame_actions = frames.get(action.frame)
+        if not frame_actions:
+            frame_actions = frames[action.frame] = []
+        frame_actions.append(action)
+
+    return frames
+
+
+class ActionReader(object):
+    # streams the actions of a solution file, they have to be ordered by frame;
+    # only the current action block is kept in memory
+    def __init__(self, f_actions):
+        self.f_actions = f_actions
+        self._actions = None
+        self._pending = None
+
+    def __iter__(self):
+        return self._parse()
+
+    def validate(self):
+        # checks the whole file up front and rewinds it, returns the number
+        # of actions
+        start = self.f_actions.tell()
+        nr_actions = 0
+        last_frame = None
+        for action in self._parse():
+            if last_frame is not None and action.frame < last_frame:
+                raise ActionSyntaxError(
+                    'Action for frame %s found after frame %s, streamed '
+                    'actions must be ordered by frame' % (
+                        action.frame, last_frame))
+            last_frame = action.frame
+            nr_actions += 1
+        self.f_actions.seek(start)
+        return nr_actions
+
+    def frame_actions(self, frame):
+        if self._actions is None:
+            self._actions = self._parse()
+            self._pending = next(self._actions, None)
+        actions = []
+        while self._pending is not None and self._pending.frame <= frame:
+            if self._pending.frame == frame:
+                actions.append(self._pending)
+            self._pending = next(self._actions, None)
+        return actions
+
+    def next_frame(self):
+        # frame of the next action in the file, None at its end
+        if self._actions is None:
+            self._actions = self._parse()
+            self._pending = next(self._actions, None)
+        if self._pending is None:
+            return None
+        return self._pending.frame
+
+    def _parse(self):
+        block = []
+        for line_no, line in enumerate(self.f_actions, 1):
+            line = line.strip()
+            if line:
+                block.append((line_no, line))
+            elif block:
+                yield self._compile(block)
+                block = []
+        if block:
+            yield self._compile(block)
+
+    def _compile(self, block):
+        items = []
+        for line_no, line in block:
+            name, sep, value = line.partition('=')
+            if not sep:
+                raise ActionSyntaxError('Line %s: expected name=value, got %r'
+                                        % (line_no, line))
+            items.append((name, value))
+        line_no = block[0][0]
+        if len(items) < 2 or items[0][0] != 'action' or items[1][0] != 'frame':
+            raise ActionSyntaxError('Line %s: an action starts with action= '
+                                    'and frame=' % (line_no,))
+        action_type = intern(items[0][1])
+        if action_type not in (Action.NEW_TOWER, Action.SHOOT):
+            raise ActionSyntaxError('Line %s: unknown action %s' % (
+                line_no, action_type))
+        try:
+            frame = int(items[1][1])
+        except ValueError:
+            raise ActionSyntaxError('Line %s: invalid frame %s' % (
+                line_no + 1, items[1][1]))
+        try:
+            return Action(action_type, frame, dict(items[2:]))
+        except ActionSyntaxError as e:
+            raise ActionSyntaxError('Line %s: %s' % (line_no, e))
+
+
+class Level(object):
+    # a parsed level, shared by all the games played on it
+    def __init__(self, settings, bugs, level_map):
+        self.settings = settings
+        # bug definitions, the games play with copies of them
+        self.bugs = bugs
+        self.map = level_map
+
+    def new_bugs(self):
+        bugs = {}
+        # in spawn order, the bugs on the map are then next to each other
+        # in memory
+        for bug_def in sorted(self.bugs, key=lambda bug_def: bug_def.frame):
+            bug = Bug(bug_def.id)
+            bug.colors = dict(bug_def.colors)
+            bug.frame = bug_def.frame
+            bugs[bug.id] = bug
+        return bugs
+
+    def new_bug_store(self, road):
+        return BugStore.from_bugs(self.bugs, road)
+
+
+class GameLost(Exception):
+    pass
+
+
+class GameSnapshot(object):
+    # the mutable part of a running TDGame; the map, the bug road, the
+    # settings and the spawn index are shared with the game
+    def __init__(self, frame, life, money, bugs_killed, nr_errors,
+                 nr_actions, towers, bugs, bugs_escaped):
+        self.frame = frame
+        self.life = life
+        self.money = money
+        self.bugs_killed = bugs_killed
+        self.nr_errors = nr_errors
+        self.nr_actions = nr_actions
+        # towers never change once built, so they are shared as well
+        self.towers = towers
+        # the bug store arrays, or the state of the bugs on the map
+        self.bugs = bugs
+        self.bugs_escaped = bugs_escaped
+
+
+class GameResult(object):
+    WON = 'won'
+    LOST = 'lost'
+    OUT_OF_BUGS = 'out_of_bugs'
+    OUT_OF_FRAMES = 'out_of_frames'
+    # the solution could not be read, the game stopped at the error
+    INVALID = 'invalid'
+
+    def __init__(self, outcome, frame, life, money, bugs_killed, error=None,
+                 error_frame=None):
+        self.outcome = outcome
+        self.frame = frame
+        self.life = life
+        self.money = money
+        self.bugs_killed = bugs_killed
+        self.error = error
+        self.error_frame = error_frame
+
+    def __str__(self):
+        return '%s - frame %s - life %s - money %s - killed %s - %s' % (
+            self.outcome, self.frame, self.life, self.money,
+            self.bugs_killed, self.error)
+
+    def __repr__(self):
+        return self.__str__()
+
+
 class TDGame(object):
-    def __init__(self):
+    def __init__(self, verbose=True, vectorized=False, fast_forward=False):
         self.is_initialized = False
         self.settings = False
         self.bugs = None
         self.map = None
         self.life = 0
         self.money = 0
-
-    def initialize(self, f_in, f_actions=None):
-        self.settings = self._read_settings(f_in)
-        self.bugs = self._read_bugs(f_in)
-        self.map = self._read_map(f_in)
+        # the first frame played is 0
+        self.frame = -1
+        # when False nothing is printed per frame (headless mode)
+        self.verbose = verbose
+        self.errors = []
+        # frame of the first error
+        self.error_frame = None
+        self.bugs_killed = 0
+        # bugs that reached the end of the road alive
+        self.bugs_escaped = 0
+        # keep the bugs in a numpy BugStore instead of a dict of Bug objects
+        self.vectorized = vectorized
+        # run_to_completion jumps over the frames where only the bugs move
+        self.fast_forward = fast_forward
+        # draws the frames instead of print_state, see tower_defense_render
+        self.renderer = None
+        # logs every frame, see tower_defense_replay
+        self.recorder = None
+        # snapshots of the past frames, see enable_checkpoints
+        self.checkpoints = None
+        self.checkpoint_every = 1
+        # shoots for the towers without a shoot action, see
+        # tower_defense_targeting
+        self.targeting = None
+
+    def initialize(self, f_in, f_actions=None, stream=False):
+        self.initialize_level(self.read_level(f_in), f_actions, stream)
+
+    def read_level(self, f_in):
+        settings = self._read_settings(f_in)
+        bugs = self._read_bugs(f_in)
+        level_map = self._read_map(f_in)
+        return Level(settings, list(bugs.values()), level_map)
+
+    def initialize_level(self, level, f_actions=None, stream=False):
+        # the settings and the map are shared with the level
+        self.level = level
+        self.settings = level.settings
+        self.map = level.map
+        if self.vectorized:
+            self.bugs = level.new_bug_store(self.map.bug_road)
+        else:
+            self.bugs = level.new_bugs()
 
         self.life = self._get_setting('starting_life')
         self.money = self._get_setting('starting_money')
 
         self.actions = []
-        if f_actions:
+        # with stream the actions are pulled from the file frame by frame
+        # and are not kept in self.actions
+        self.action_reader = None
+        if f_actions and stream:
+            self.action_reader = ActionReader(f_actions)
+            self.action_reader.validate()
+        elif f_actions:
             self.actions = self._read_actions(f_actions)
         self.is_initialized = True
         self.simulation_started = False
@@ -253,34 +1024,492 @@ class TDGame(object):
         if self.simulation_started:
             return
         self.towers = {}
+        # occupancy grid with the id of the tower built on each cell
+        self.tower_grid = [[None] * len(row) for row in self.map.rows]
         self.frame = -1
         self.frames = self._group_by_frame(self.actions)
+        self.spawns = self._group_by_spawn_frame()
+        # spawn queue: the spawn frames in order and the next one due
+        self.spawn_frames = sorted(self.spawns)
+        self.next_spawn = 0
+        # the frames with actions in order and the road offsets in range of
+        # the towers, see next_event_frame
+        self.action_frames = []
+        self.covered = None
+        # the bugs on the map, in the vectorized store these are the rows
+        # between its lo and hi
+        self.active = {}
+        # waiting bugs without health or with a negative one, the first
+        # frame kills them or turns the negative health into damage
+        self.pending = []
+        if not self.vectorized:
+            self.pending = [bug for bug in self.bugs.values()
+                            if bug.frame > 0 and
+                            (not any(val > 0 for val in bug.colors.values()) or
+                             any(val < 0 for val in bug.colors.values()))]
+            self.active.update((bug.id, bug) for bug in self.pending)
+            self._queue_waiting_bugs()
+        # ids of the bugs whose colors dict is held by a snapshot as well
+        self.shared_colors = set()
+        # bugs found dead on the current frame
+        self.nr_dead = 0
         self.simulation_started = True
-        self.print_state()
+        if self.recorder is not None:
+            self.recorder.start()
+        if self.renderer is not None:
+            self.renderer.render()
+        elif self.verbose:
+            self.print_state()
+
+    def _queue_waiting_bugs(self):
+        # the bugs that did not enter yet keep their starting state, so the
+        # snapshots share them with the game instead of copying them;
+        # waiting_from[i] is where the bugs of spawn_frames[i] start
+        pending = set(bug.id for bug in self.pending)
+        self.waiting = []
+        self.waiting_colors = []
+        self.waiting_from = []
+        for frame in self.spawn_frames:
+            self.waiting_from.append(len(self.waiting))
+            for bug_id in self.spawns[frame]:
+                if bug_id in pending:
+                    continue
+                self.waiting.append((bug_id, self.bugs[bug_id]))
+                self.waiting_colors.append(dict(self.bugs[bug_id].colors))
+        self.waiting_from.append(len(self.waiting))
 
     def next_step(self):
         if not self.simulation_started:
             return
         self.frame += 1
+        actions = self._frame_actions()
+        if self.verbose and self.renderer is None:
+            print(actions)
+
+        try:
+            self._build_towers(actions)
+            self._move_bugs()
+            self._put_bugs_on_map()
+            if self.targeting is not None:
+                actions = self.targeting.target(actions)
+            self._shoot(actions)
+            # will mark dead bugs
+            self._check_dead_bugs()
+            # compute damage
+            self._compute_damage()
+            self._check_life()
+            self._give_rewards()
+            finished = self._check_game_finished()
+            if finished:
+                self._log('The game has finished. You KILLED all the BUGS!')
+            self._clear_bugs()
+        finally:
+            # the frame is recorded even when it ends the game
+            if self.recorder is not None:
+                self.recorder.record(actions)
+        if self.checkpoints is not None:
+            # checkpoints[i] is the state after frame i - 1, it is only kept
+            # every checkpoint_every frames and None in between
+            del self.checkpoints[self.frame + 1:]
+            if (self.frame + 1) % self.checkpoint_every:
+                self.checkpoints.append(None)
+            else:
+                self.checkpoints.append(self.snapshot())
+
+        if self.renderer is not None:
+            self.renderer.render()
+        elif self.verbose:
+            self.print_state()
+        return finished
+
+    def _frame_actions(self):
         actions = self.frames.get(self.frame)
-        print(actions)
-
-        self._build_towers(actions)
-        self._move_bugs()
-        self._put_bugs_on_map()
-        self._shoot(actions)
-        # will mark dead bugs
-        self._check_dead_bugs()
-        # compute damage
-        self._compute_damage()
-        self._check_life()
-        self._give_rewards()
-        finished = self._check_game_finished()
-        if finished:
-            print('The game has finished. You KILLED all the BUGS!')
-        self._clear_bugs()
-
-        self.print_state()
+        if self.action_reader is None:
+            return actions
+        streamed = self.action_reader.frame_actions(self.frame)
+        if actions:
+            streamed.extend(actions)
+        return streamed
+
+    def run_to_completion(self, render_every=None, max_frames=None):
+        # steps without printing until the game is won, lost or out of bugs;
+        # the state is rendered every `render_every` frames if requested
+        verbose = self.verbose
+        self.verbose = False
+        try:
+            self.start_simulation()
+            while True:
+                if self.fast_forward:
+                    end = max_frames
+                    if render_every:
+                        # the rendered frames are played
+                        render = (self.frame // render_every + 1) * render_every
+                        end = render if end is None else min(end, render)
+                    self.skip_idle_frames(end)
+                if max_frames is not None and self.frame + 1 >= max_frames:
+                    return self._result(GameResult.OUT_OF_FRAMES)
+                try:
+                    finished = self.next_step()
+                except GameLost:
+                    return self._result(GameResult.LOST)
+                except ActionSyntaxError as e:
+                    # a broken streamed action is an error of the solution
+                    self._error(str(e))
+                    return self._result(GameResult.INVALID)
+                if render_every and self.frame % render_every == 0:
+                    self.print_state()
+                if finished:
+                    return self._result(GameResult.WON)
+                if self._is_out_of_bugs():
+                    return self._result(GameResult.OUT_OF_BUGS)
+        finally:
+            self.verbose = verbose
+
+    def next_event_frame(self):
+        # the next frame on which more than the moves of the bugs happens:
+        # an action, a spawn, a bug at the end of the road or, with the
+        # targeting, a bug in range of a tower; None if there is none
+        frame = self.frame
+        events = []
+        if self.action_reader is not None:
+            events.append(self.action_reader.next_frame())
+        else:
+            if len(self.action_frames) != len(self.frames):
+                self.action_frames = sorted(self.frames)
+            i = bisect.bisect_right(self.action_frames, frame)
+            while i < len(self.action_frames):
+                if self.frames.get(self.action_frames[i]):
+                    events.append(self.action_frames[i])
+                    break
+                i += 1
+        i = bisect.bisect_right(self.spawn_frames, frame)
+        if i < len(self.spawn_frames):
+            events.append(self.spawn_frames[i])
+
+        last = len(self.map.bug_road) - 1
+        if self.vectorized:
+            store = self.bugs
+            offsets = store.offset[store.lo:store.hi]
+            offsets = offsets[store.alive[store.lo:store.hi]]
+            if len(offsets):
+                events.append(frame + last - int(offsets.max()))
+        else:
+            offsets = [bug.offset for bug in self.active.values()
+                       if bug.offset is not None]
+            if offsets:
+                events.append(frame + last - max(offsets))
+        if self.targeting is not None and self.towers and len(offsets):
+            next_covered = self._next_covered()
+            events.append(frame + min(next_covered[min(offset + 1, last)] - offset
+                                      for offset in set(int(o) for o in offsets)))
+        events = [event for event in events if event is not None]
+        if not events:
+            return None
+        return max(min(events), frame + 1)
+
+    def _next_covered(self):
+        # next_covered[o]: the first offset from o on in range of a tower;
+        # towers are only added, a restored game has other tower objects
+        towers = list(self.towers.values())
+        key = (len(towers), towers[-1])
+        if self.covered is None or self.covered[0] != key:
+            covered = set()
+            for tower in towers:
+                covered.update(tower.road_offsets)
+            last = len(self.map.bug_road) - 1
+            next_covered = [last + 1] * (last + 2)
+            for offset in range(last, -1, -1):
+                next_covered[offset] = (offset if offset in covered
+                                        else next_covered[offset + 1])
+            self.covered = (key, next_covered)
+        return self.covered[1]
+
+    def skip_idle_frames(self, end=None):
+        # plays the frames before the next event at once: they only move the
+        # bugs, so the bug offsets are advanced by the number of frames; the
+        # game stops before frame `end`. Returns the number of frames skipped
+        if not self.simulation_started or self.frame < 0:
+            # the first frame also handles the bugs waiting without health
+            return 0
+        if (self.recorder is not None or self.renderer is not None or
+                self.checkpoints is not None):
+            # they need every frame
+            return 0
+        target = self.next_event_frame()
+        if target is None:
+            return 0
+        if end is not None:
+            target = min(target, end)
+        skip = target - 1 - self.frame
+        if skip <= 0:
+            return 0
+        self.frame += skip
+        last = len(self.map.bug_road) - 1
+        if self.vectorized:
+            store = self.bugs
+            offset = store.offset[store.lo:store.hi]
+            np.minimum(offset + skip, last, out=offset)
+            store.finished[store.lo:store.hi] = offset == last
+        else:
+            for bug in self.active.values():
+                if bug.offset is not None:
+                    bug.offset = min(bug.offset + skip, last)
+        return skip
+
+    def snapshot(self):
+        if not self.simulation_started:
+            raise Exception('The simulation has not started')
+        if self.vectorized:
+            bugs = self.bugs.snapshot()
+        else:
+            # the waiting bugs are known from the frame, see restore; the
+            # colors are shared until they change and the state is kept in
+            # columns, a tuple per bug keeps the garbage collector busy
+            active = list(self.active.values())
+            bugs = (active, [bug.colors for bug in active],
+                    [bug.offset for bug in active],
+                    [bug.dead for bug in active],
+                    [bug.finished for bug in active])
+            self.shared_colors = set(self.active)
+        return GameSnapshot(self.frame, self.life, self.money,
+                            self.bugs_killed, len(self.errors),
+                            len(self.actions), list(self.towers.values()),
+                            bugs, self.bugs_escaped)
+
+    def restore(self, snap, keep_actions=False):
+        if self.action_reader is not None:
+            raise Exception('Can not go back in a game that streams its actions')
+        self.frame = snap.frame
+        self.life = snap.life
+        self.money = snap.money
+        self.bugs_killed = snap.bugs_killed
+        del self.errors[snap.nr_errors:]
+        if not self.errors:
+            self.error_frame = None
+        if not keep_actions:
+            # forget the actions added after the snapshot
+            for action in self.actions[snap.nr_actions:]:
+                self.frames[action.frame].remove(action)
+            del self.actions[snap.nr_actions:]
+
+        for tower in self.towers.values():
+            self.tower_grid[tower.position.y][tower.position.x] = None
+        self.towers = {}
+        for tower in snap.towers:
+            self.towers[tower.id] = tower
+            self.tower_grid[tower.position.y][tower.position.x] = tower.id
+
+        next_spawn = bisect.bisect_right(self.spawn_frames, self.frame)
+        if self.vectorized:
+            self.bugs.restore(snap.bugs)
+        else:
+            # the bugs that entered after the snapshot wait again
+            start = self.waiting_from[next_spawn]
+            for i in range(start, self.waiting_from[self.next_spawn]):
+                bug = self.waiting[i][1]
+                bug.colors = dict(self.waiting_colors[i])
+                bug.offset = None
+                bug.dead = False
+                bug.finished = False
+            self.active = {}
+            for bug, colors, offset, dead, finished in zip(*snap.bugs):
+                bug.colors = colors
+                bug.offset = offset
+                bug.dead = dead
+                bug.finished = finished
+                self.active[bug.id] = bug
+            self.shared_colors = set(self.active)
+            # the cleared bugs are neither on the map nor waiting
+            self.bugs = dict(self.active)
+            self.bugs.update(self.waiting[start:])
+        self.bugs_escaped = snap.bugs_escaped
+        self.next_spawn = next_spawn
+
+    def same_state(self, snap, other):
+        # True if the two snapshots of this game hold the same state
+        if ((snap.frame, snap.life, snap.money, snap.bugs_killed,
+             snap.nr_errors, snap.bugs_escaped) !=
+                (other.frame, other.life, other.money, other.bugs_killed,
+                 other.nr_errors, other.bugs_escaped)):
+            return False
+        towers = [dict((tower.id, (tower.position.x, tower.position.y,
+                                   tower.colors))
+                       for tower in s.towers) for s in (snap, other)]
+        if towers[0] != towers[1]:
+            return False
+        if self.vectorized:
+            return all(np.array_equal(a, b)
+                       for a, b in zip(snap.bugs, other.bugs))
+        bugs = [dict((state[0].id, state[1:]) for state in zip(*s.bugs))
+                for s in (snap, other)]
+        return bugs[0] == bugs[1]
+
+    def enable_checkpoints(self, every=16):
+        # keep a snapshot every `every` frames, so that editing the actions of
+        # a past frame only plays the game again from the snapshot before it
+        if self.action_reader is not None:
+            raise Exception('Can not checkpoint a game that streams its actions')
+        self.start_simulation()
+        self.checkpoint_every = every
+        self.checkpoints = [None] * (self.frame + 1) + [self.snapshot()]
+
+    def add_action(self, action):
+        old_frames = self._frame_actions_copy([action.frame])
+        self._add_action_to_game(action)
+        return self._actions_edited(action.frame, old_frames=old_frames)
+
+    def remove_action(self, action):
+        old_frames = self._frame_actions_copy([action.frame])
+        self.actions.remove(action)
+        self.frames[action.frame].remove(action)
+        return self._actions_edited(action.frame, old_frames=old_frames)
+
+    def replace_action(self, action, new_action):
+        old_frames = self._frame_actions_copy([action.frame, new_action.frame])
+        self.actions[self.actions.index(action)] = new_action
+        self.frames[action.frame].remove(action)
+        self.frames.setdefault(new_action.frame, []).append(new_action)
+        return self._actions_edited(min(action.frame, new_action.frame),
+                                    max(action.frame, new_action.frame),
+                                    old_frames)
+
+    def _frame_actions_copy(self, frames):
+        return dict((frame, list(self.frames.get(frame, ())))
+                    for frame in frames)
+
+    def _actions_edited(self, frame, last_frame=None, old_frames=None):
+        if self.checkpoints is None or frame > self.frame:
+            # the frame was not played yet
+            return None
+        return self.resimulate(frame, last_frame, old_frames)
+
+    def resimulate(self, frame, last_frame=None, old_frames=None):
+        # plays the game again from `frame` up to the current frame and
+        # returns the first frame whose state differs from the last run,
+        # None if the edit changed nothing; the rest of the last run is
+        # reused as soon as both runs reach the same state after the last
+        # edited frame. The game goes back to the checkpoint before `frame`
+        # and the states are compared on the checkpoints; old_frames,
+        # {frame: actions} of the edited frames before the edit, lets the
+        # edited frames be compared as well, without it the frame returned
+        # is the first one that may differ
+        if last_frame is None:
+            last_frame = frame
+        checkpoints = self.checkpoints
+        if checkpoints is None:
+            raise Exception('Checkpoints are not enabled')
+        start = frame
+        while start >= 0 and checkpoints[start] is None:
+            start -= 1
+        if start < 0:
+            raise Exception('There is no checkpoint before frame %s' % (frame, ))
+        end = self.frame
+        old = checkpoints[:]
+        old_errors = list(self.errors)
+        old_error_frame = self.error_frame
+        # the state the last run ended with
+        old_end = self.snapshot()
+        diverged = None
+        # first frame since the last comparison that was not compared
+        unchecked = None
+        verbose = self.verbose
+        self.verbose = False
+        try:
+            old_states = {end: old_end}
+            if old_frames is not None:
+                old_states.update(self._replay_old_frames(
+                    start, frame, min(last_frame, end), old_frames))
+            self.restore(checkpoints[start], keep_actions=True)
+            del checkpoints[start + 1:]
+            while self.frame < end:
+                try:
+                    self.next_step()
+                except GameLost:
+                    if diverged is None and self.frame + 1 < len(old):
+                        diverged = self.frame if unchecked is None else unchecked
+                    return diverged
+                if self.frame < frame:
+                    # played with the same actions as the last run
+                    continue
+                if self.frame + 1 >= len(old):
+                    # the last run was lost on this frame
+                    if diverged is None:
+                        diverged = self.frame if unchecked is None else unchecked
+                    continue
+                other = old[self.frame + 1] or old_states.get(self.frame)
+                if other is None:
+                    # nothing to compare with on this frame
+                    if unchecked is None:
+                        unchecked = self.frame
+                    continue
+                snap = checkpoints[-1] or self.snapshot()
+                if not self.same_state(snap, other):
+                    if diverged is None:
+                        diverged = self.frame if unchecked is None else unchecked
+                    continue
+                unchecked = None
+                if self.frame < last_frame:
+                    continue
+                # from here on the last run would be played again
+                self.errors[len(self.errors):] = old_errors[len(self.errors):]
+                checkpoints.extend(old[self.frame + 2:])
+                self.restore(old_end, keep_actions=True)
+                if self.errors and self.error_frame is None:
+                    self.error_frame = old_error_frame
+        finally:
+            self.verbose = verbose
+        return diverged
+
+    def _replay_old_frames(self, start, frame, last_frame, old_frames):
+        # the states of the last run after the frames from `frame` to
+        # `last_frame` that have no checkpoint, played from the checkpoint
+        # before `frame` with the actions the frames had before the edit
+        checkpoints = self.checkpoints
+        if all(checkpoints[i + 1] is not None
+               for i in range(frame, min(last_frame + 1, len(checkpoints) - 1))):
+            return {}
+        new_frames = self._frame_actions_copy(old_frames)
+        self.frames.update(old_frames)
+        self.checkpoints = None
+        states = {}
+        try:
+            self.restore(checkpoints[start], keep_actions=True)
+            while self.frame < last_frame:
+                self.next_step()
+                if self.frame >= frame:
+                    states[self.frame] = self.snapshot()
+        except GameLost:
+            pass
+        finally:
+            self.frames.update(new_frames)
+            self.checkpoints = checkpoints
+        return states
+
+    def _result(self, outcome):
+        error = self.errors[0] if self.errors else None
+        return GameResult(outcome, self.frame, self.life, self.money,
+                          self.bugs_killed, error, self.error_frame)
+
+    def bug_counts(self):
+        # (bugs on the map, bugs on the map or still waiting to enter)
+        if self.vectorized:
+            return (self.bugs.active(), len(self.bugs))
+        return (len([bug for bug in self.active.values()
+                     if bug.offset is not None]), len(self.bugs))
+
+    def _is_out_of_bugs(self):
+        # no bug is waiting to enter the game or still walking the road
+        return not len(self.bugs)
+
+    def _log(self, message):
+        if self.verbose:
+            print(message)
+
+    def _error(self, message):
+        if not self.errors:
+            self.error_frame = self.frame
+        self.errors.append(message)
+        self._log('ERROR: ' + message)
 
     def dump_actions(self, f_solution):
         dump_actions = []
@@ -299,21 +1528,12 @@ class TDGame(object):
         f_solution.flush()
 
     def action_new_tower(self, tower_id, position, colors):
-        x = position[0]
-        y = position[1]
-        attrs = {
-            'name': tower_id,
-            'position': ','.join([str(x),str(y)]),
-            'colors': ','.join(['%s:%s' % (name, val)
-                                for name, val in colors.items()])
-        }
-        action = Action(Action.NEW_TOWER, self.frame+1, attrs)
+        action = Action.new_tower(self.frame+1, tower_id, position, colors)
         self._add_action_to_game(action)
 
     def action_shoot(self, tower_id, bug_id):
-        attrs = {'tower_name': tower_id, 'bug_name': bug_id}
-        action = Action(Action.SHOOT, self.frame+1, attrs)
-        self._add_action_to_game(action)        
+        action = Action.shoot(self.frame+1, tower_id, bug_id)
+        self._add_action_to_game(action)
 
     def _add_action_to_game(self, action):
         self.actions.append(action)
@@ -328,70 +1548,99 @@ class TDGame(object):
                 continue
 
             # check if id of tower already exists
-            tower_id = action.attrs.get('name')
+            tower_id = action.tower_id
             if tower_id in self.towers:
-                print('ERROR: There is already a tower with the same id %s' % (tower_id,))
+                self._error('There is already a tower with the same id %s' % (tower_id,))
                 return
-            # check if the position is valid
-            pos = self._parse_tower_postion(action.attrs.get('position'))
+            pos = Position(action.position[0], action.position[1])
             # check position is valid on map
             if not self.map.check_tower_pos(pos.x, pos.y):
-                print('ERROR: Can not build a tower on position %s' % (pos,))
+                self._error('Can not build a tower on position %s' % (pos,))
                 return
             # check that there are no other towers on this position
             if self._is_tower_in_pos(pos.x, pos.y):
-                print('ERROR: Tower is already build on position %s' % (pos,))
+                self._error('Tower is already build on position %s' % (pos,))
 
             # check if we have enough resources
             if self.money < self._get_setting('tower_cost'):
-                print('ERROR: not enought resources to build a tower')
+                self._error('not enought resources to build a tower')
                 return
             self.money -= self._get_setting('tower_cost')
 
-            tower = Tower(action.attrs.get('name'))
-            tower.set_colors(action.attrs.get('colors'))
-            tower.set_position(action.attrs.get('position'))
+            tower = Tower(tower_id)
+            tower.colors = dict(action.colors)
+            tower.position = pos
+            tower.cover_road(self.map.road_offsets,
+                             self._get_setting('tower_range'))
             self.towers[tower.id] = tower
+            self.tower_grid[pos.y][pos.x] = tower.id
 
     def _is_tower_in_pos(self, x, y):
-        for tower in self.towers.values():
-            if tower.position.x == x and tower.position.y == y:
-                return True
-        return False
+        return self.tower_grid[y][x] is not None
+
+    def bugs_in_range(self, tower_id, frame=None):
+        # a bug spawned at frame f walks one road cell per frame, so the bugs
+        # on a covered offset are the ones spawned offset frames ago; a later
+        # frame can be given to see which bugs will be in range after moving;
+        # the bugs that finish the road are retired on the same frame
+        if frame is None:
+            frame = self.frame
+        tower = self.towers[tower_id]
+        bugs = []
+        for offset in tower.road_offsets:
+            bug_ids = self.spawns.get(frame - offset, ())
+            bugs.extend(self.bugs[bug_id] for bug_id in bug_ids
+                        if bug_id in self.bugs)
+        return bugs
 
-    def _parse_tower_postion(self, pos_str):
-        x = int(pos_str.split(',')[0])
-        y = int(pos_str.split(',')[1])
-        return Position(x, y)
+    def _group_by_spawn_frame(self):
+        spawns = {}
+        for bug in self.bugs.values():
+            spawns.setdefault(bug.frame, []).append(bug.id)
+        return spawns
 
     def _move_bugs(self):
-        for bug in self.bugs.values():
-            if not bug.position:
+        if self.vectorized:
+            self.bugs.move()
+            return
+        for bug in self.active.values():
+            if bug.offset is None:
+                # a pending bug, see start_simulation
                 continue
-            bug.position = self._next_bug_pos(bug)
-            # get bug position on bug road
+            bug.offset = self._next_bug_offset(bug)
             if self._is_bug_finished(bug):
                 bug.finished = True
 
     def _is_bug_finished(self, bug):
-        return bug.position == self.map.end
+        return bug.offset == len(bug.road) - 1
+
+    def _next_bug_offset(self, bug):
+        if bug.offset + 1 >= len(bug.road):
+            return bug.offset
+        return bug.offset + 1
 
     def _next_bug_pos(self, bug):
-        if not bug.position:
+        if bug.offset is None:
             return None
-        try:
-            bug_pos_index = self.map.bug_road.index(bug.position)
-            if bug_pos_index + 1 >= len(self.map.bug_road):
-                return bug.position
-            return self.map.bug_road[bug_pos_index+1]
-        except ValueError:
-            return None 
+        return bug.road[self._next_bug_offset(bug)]
 
     def _put_bugs_on_map(self):
-        for bug in self.bugs.values():
-            if bug.frame == self.frame:
+        if self.vectorized:
+            self.bugs.put_on_map(self.frame)
+            return
+        # only the due frames are taken from the spawn queue
+        spawn_frames = self.spawn_frames
+        while (self.next_spawn < len(spawn_frames) and
+               spawn_frames[self.next_spawn] <= self.frame):
+            for bug_id in self.spawns[spawn_frames[self.next_spawn]]:
                 # the bug will enter the game
-                bug.position = self.map.start
+                bug = self.bugs.get(bug_id)
+                if bug is None:
+                    # killed while it was pending
+                    continue
+                bug.place(self.map.bug_road, 0)
+                self.active[bug_id] = bug
+            self.next_spawn += 1
 
     def _shoot(self, actions):
         already_shot = set()
@@ -400,38 +1649,61 @@ class TDGame(object):
         for action in actions:
             if not action.action_type == Action.SHOOT:
                 continue
-            tower_id = action.attrs.get('tower_name')
-            bug_id = action.attrs.get('bug_name')
+            tower_id = action.tower_id
+            bug_id = action.bug_id
             if tower_id in already_shot:
-                print('ERROR: This tower already shot: %s' % (tower_id,))
+                self._error('This tower already shot: %s' % (tower_id,))
 
             tower = self.towers.get(tower_id)
             bug = self.bugs.get(bug_id)
 
-            if not bug or not self._in_range(tower, bug):
-                print('ERROR: bug not in range of tower (%s - %s)' % (bug.id, tower.id))
+            if not tower or not bug or not bug.position:
+                self._error('no such tower or bug on map (%s - %s)' % (tower_id, bug_id))
+                continue
+            if not self._in_range(tower, bug):
+                self._error('bug not in range of tower (%s - %s)' % (bug.id, tower.id))
+            colors = bug.colors
+            if any(color not in colors for color in tower.colors):
+                self._error('bug does not have the colors of tower (%s - %s)' % (
+                    bug.id, tower.id))
+                continue
 
             self._apply_shot(tower, bug)
             already_shot.add(tower_id)
 
     def _in_range(self, tower, bug):
-        tower_range = self.settings.get('tower_range')
-        dx = abs(tower.position.x - bug.position.x)
-        dy = abs(tower.position.y - bug.position.y)
-        return tower_range >= max(dx, dy)
+        return tower.covers(bug.offset)
 
     def _apply_shot(self, tower, bug):
+        colors = self._writable_colors(bug)
         for color, value in tower.colors.items():
-            bug_value = bug.colors.get(color) - value
-            bug.colors[color] = bug_value
+            bug_value = colors.get(color) - value
+            colors[color] = bug_value
+
+    def _writable_colors(self, bug):
+        # the colors are copied on the first change after a snapshot
+        if bug.id in self.shared_colors:
+            self.shared_colors.discard(bug.id)
+            bug.colors = dict(bug.colors)
+        return bug.colors
 
     def _check_dead_bugs(self):
-        for bug in self.bugs.values():
+        if self.vectorized:
+            self.bugs.check_dead()
+            self.nr_dead = self.bugs.count_dead()
+            return
+        self.nr_dead = 0
+        for bug in self.active.values():
             bug.check_dead()
+            if bug.dead:
+                self.nr_dead += 1
 
     def _compute_damage(self):
+        if self.vectorized:
+            self.life -= self.bugs.compute_damage()
+            return
         damage = 0
-        for bug in self.bugs.values():
+        for bug in self.active.values():
             damage += self._damage_per_bug(bug)
         self.life -= damage
 
@@ -445,34 +1717,38 @@ class TDGame(object):
             val = bug.colors[color]
             if val < 0:
                 damage += -val
-                bug.colors[color] = 0
+                self._writable_colors(bug)[color] = 0
         return damage
 
     def _check_life(self):
         # if life is <= 0 then the solution is invalid and the games stops
         if self.life <= 0:
-            raise Exception('YOU ARE DEAD !!!')
+            raise GameLost('YOU ARE DEAD !!!')
 
     def _give_rewards(self):
         reward = self.settings.get('reward_per_bug')
-        for bug in self.bugs.values():
-            if bug.dead:
-                self.money += reward
+        self.money += reward * self.nr_dead
+        self.bugs_killed += self.nr_dead
 
     def _check_game_finished(self):
-        for bug in self.bugs.values():
-            if not bug.dead:
-                return False
-        return True
+        # all the bugs are dead, none waits to enter and none escaped
+        return self.bugs_escaped == 0 and self.nr_dead == len(self.bugs)
 
     def _clear_bugs(self):
         # will clear dead bugs or bugs who have finished the race
+        if self.vectorized:
+            self.bugs_escaped += self.bugs.clear()
+            return
         del_bugs = []
-        for bug_id, bug in self.bugs.items():
+        for bug_id, bug in self.active.items():
             if bug.dead:
                 del_bugs.append(bug_id)
+            elif bug.finished:
+                self.bugs_escaped += 1
+                del_bugs.append(bug_id)
         for bug_id in del_bugs:
             self.bugs.pop(bug_id)
+            self.active.pop(bug_id)
 
     def print_state(self):
         self.map.show(self.bugs.values(), self.towers.values())
@@ -494,41 +1770,10 @@ class TDGame(object):
             print(tower)
 
     def _read_actions(self, f_actions):
-        actions = []
-        action = self._read_action(f_actions)
-        while action:
-            actions.append(action)
-            action = self._read_action(f_actions)
-
-        return actions
+        return list(ActionReader(f_actions))
 
     def _group_by_frame(self, actions):
-        frames = {}
-        for action in actions:
-            frame_actions = frames.get(action.frame)
-            if not frame_actions:
-                frame_actions = frames[action.frame] = []
-            frame_actions.append(action)
-
-        return frames
-
-    def _read_action(self, f_actions):
-        type_line = f_actions.readline().strip()
-        frame_line = f_actions.readline().strip()
-        if (not type_line) or (not frame_line):
-            return None
-
-        action_type = type_line.split('=')[1]
-        frame = int(frame_line.split('=')[1])
-        attrs = {}
-        attr_line = f_actions.readline().strip()
-        while attr_line:
-            name = attr_line.split('=')[0]
-            value = attr_line.split('=')[1]
-            attrs[name] = value
-            attr_line = f_actions.readline().strip()
-
-        return Action(action_type, frame, attrs)
+        return group_by_frame(actions)
 
     def _read_map(self, f_in):
         rows = []
@@ -594,6 +1839,13 @@ if __name__ == '__main__':
     # go to next frame:
     # game.next_step()
 
+    # or play the whole solution without printing every frame:
+    # print(game.run_to_completion(render_every=10))
+
+    # or watch it live, only the changed cells are redrawn:
+    # from tower_defense_render import TerminalRenderer
+    # game.renderer = TerminalRenderer(game, every=2)
+
     # add new tower in next frame
     # game.action_new_tower('T3', (0,1), {'red': 1})
 
@@ -0,0 +1,93 @@
+import argparse
+import csv
+import multiprocessing
+import sys
+
+from tower_defense import ActionSyntaxError, GameResult, TDGame
+
+
+COLUMNS = ['file', 'outcome', 'life', 'money', 'frame', 'failure_frame',
+           'error']
+
+_level = None
+_vectorized = False
+
+
+def _init_worker(level, vectorized):
+    # the level is parsed once by the parent and inherited by the workers
+    global _level, _vectorized
+    _level = level
+    _vectorized = vectorized
+
+
+def read_level(f_in):
+    return TDGame().read_level(f_in)
+
+
+def score_file(path):
+    game = TDGame(verbose=False, vectorized=_vectorized)
+    try:
+        with open(path) as f_actions:
+            game.initialize_level(_level, f_actions)
+        result = game.run_to_completion()
+    except ActionSyntaxError as e:
+        # the solution is scored as invalid before its first frame
+        game._error(str(e))
+        result = game._result(GameResult.INVALID)
+    except Exception as e:
+        # a broken solution file should not stop the whole batch
+        return [path, 'crashed', None, None, None, None, repr(e)]
+    if result.outcome == result.LOST:
+        failure_frame = result.frame
+    else:
+        failure_frame = result.error_frame
+    return [path, result.outcome, result.life, result.money, result.frame,
+            failure_frame, result.error]
+
+
+def score_files(level, paths, processes=None, vectorized=False):
+    if processes == 1:
+        _init_worker(level, vectorized)
+        return [score_file(path) for path in paths]
+    pool = multiprocessing.Pool(processes, _init_worker, (level, vectorized))
+    try:
+        # small chunks keep the workers busy when the games differ in length
+        return pool.map(score_file, paths, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def print_table(rows, f_out=sys.stdout):
+    table = [COLUMNS] + [['' if val is None else str(val) for val in row]
+                         for row in rows]
+    widths = [max(len(row[i]) for row in table) for i in range(len(COLUMNS))]
+    for row in table:
+        f_out.write('  '.join(val.ljust(width)
+                              for val, width in zip(row, widths)).rstrip())
+        f_out.write('\n')
+
+
+def write_csv(rows, f_out):
+    writer = csv.writer(f_out)
+    writer.writerow(COLUMNS)
+    writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Score many solution files against one level.')
+    parser.add_argument('level')
+    parser.add_argument('solutions', nargs='+')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--vectorized', action='store_true')
+    parser.add_argument('--csv', help='also write the results to this file')
+    args = parser.parse_args()
+
+    with open(args.level) as f_in:
+        level = read_level(f_in)
+    rows = score_files(level, args.solutions, args.processes, args.vectorized)
+    print_table(rows)
+    if args.csv:
+        with open(args.csv, 'w') as f_csv:
+            write_csv(rows, f_csv)
@@ -0,0 +1,339 @@
+import argparse
+import io
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from tower_defense import Action, Map, Position, TDGame, Tower
+from tower_defense_profile import PHASES, PhaseProfiler
+
+COLORS = ['red', 'blue', 'green', 'black', 'white', 'yellow', 'orange',
+          'purple']
+
+# every case starts from BASE_CASE and changes one dimension
+BASE_CASE = {'width': 40, 'height': 21, 'road_length': 300, 'nr_bugs': 1000,
+             'nr_colors': 2, 'nr_towers': 20, 'spawn_frames': 200,
+             'tower_range': 1}
+SUITES = {
+    'bugs': ('nr_bugs', [100, 1000, 10000, 50000]),
+    'road': ('road_length', [50, 150, 300, 400]),
+    'grid': ('width', [40, 80, 160, 320]),
+    'colors': ('nr_colors', [1, 2, 4, 8]),
+    'towers': ('nr_towers', [5, 20, 80, 160]),
+}
+# fps drops bigger than this are reported as regressions
+REGRESSION = 0.8
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def serpentine_road(width, height, road_length):
+    # the road walks the even rows from side to side and goes down one row
+    # at their ends, so no two parts of it touch
+    road = []
+    for y in range(0, height, 2):
+        xs = list(range(width)) if (y // 2) % 2 == 0 else list(range(width - 1, -1, -1))
+        road.extend((x, y) for x in xs)
+        if y + 2 < height:
+            road.append((xs[-1], y + 1))
+    if road_length > len(road):
+        raise Exception('A %sx%s grid can not hold a road of %s cells' % (
+            width, height, road_length))
+    return road[:road_length]
+
+
+def touching_road(width, height):
+    # a serpentine on every row: the parts of the road touch each other, so
+    # the corridor has to be walked cell by cell and not by the shortest way
+    road = []
+    for y in range(height):
+        xs = list(range(width)) if y % 2 == 0 else list(range(width - 1, -1, -1))
+        road.extend((x, y) for x in xs)
+    return road
+
+
+def road_rows(width, height, road):
+    rows = [['0'] * width for y in range(height)]
+    for x, y in road:
+        rows[y][x] = '1'
+    rows[road[0][1]][road[0][0]] = 'E'
+    rows[road[-1][1]][road[-1][0]] = 'X'
+    return rows
+
+
+def check_roads(f_out=sys.stdout):
+    # regression check of Map.bug_road on corridors that touch themselves,
+    # returns the number of roads that were not walked as expected
+    cases = [(4, 2, [(0, 0), (1, 0), (2, 0), (3, 0),
+                     (3, 1), (2, 1), (1, 1), (0, 1)]),
+             (4, 4, [(0, 0), (1, 0), (2, 0), (3, 0), (3, 1), (2, 1), (1, 1),
+                     (0, 1), (0, 2), (0, 3), (1, 3), (2, 3), (3, 3)])]
+    for width, height in [(2, 3), (5, 5), (40, 21)]:
+        cases.append((width, height, touching_road(width, height)))
+    failed = 0
+    for width, height, road in cases:
+        bug_road = Map(road_rows(width, height, road)).bug_road
+        if [(pos.x, pos.y) for pos in bug_road] != road:
+            failed += 1
+            f_out.write('%sx%s road of %s cells walked in %s cells\n' % (
+                width, height, len(road), len(bug_road)))
+    return failed
+
+
+def generate_level(width, height, road_length, nr_bugs, nr_colors,
+                   spawn_frames, tower_range=1, nr_towers=0, seed=0, **kwargs):
+    # the text of a valid level: settings, bugs and map as read by TDGame
+    rnd = random.Random(seed)
+    rows = [['0'] * width for y in range(height)]
+    road = serpentine_road(width, height, road_length)
+    for x, y in road:
+        rows[y][x] = '1'
+    rows[road[0][1]][road[0][0]] = 'E'
+    rows[road[-1][1]][road[-1][0]] = 'X'
+    colors = COLORS[:nr_colors]
+
+    lines = ['starting_life=%s' % (10 ** 15, ),
+             'starting_money=%s' % (10 * nr_towers, ),
+             'tower_range=%s' % (tower_range, ),
+             'tower_cost=10',
+             'reward_per_bug=1',
+             # the settings reader consumes the line after the settings
+             '']
+    for i in range(nr_bugs):
+        attrs = ['%s=%s' % (color, rnd.randint(1, 9)) for color in colors]
+        attrs.append('frame=%s' % (rnd.randint(0, spawn_frames - 1), ))
+        lines.append('B%s %s' % (i + 1, ' '.join(attrs)))
+    lines.append('')
+    lines.extend(' '.join(row) for row in rows)
+    return '\n'.join(lines) + '\n'
+
+
+def generate_actions(level, nr_towers, seed=0):
+    # random valid actions: the towers are built on free cells next to the
+    # road on the first frames and shoot bugs in their range that are alive
+    rnd = random.Random(seed)
+    level_map = level.map
+    road = level_map.bug_road
+    last = len(road) - 1
+    tower_range = level.settings['tower_range']
+    cells = []
+    for y, row in enumerate(level_map.rows):
+        for x, val in enumerate(row):
+            if val == '0':
+                cells.append((x, y))
+    rnd.shuffle(cells)
+
+    colors = sorted(set(color for bug in level.bugs for color in bug.colors))
+    towers = []
+    actions = []
+    for x, y in cells:
+        if len(towers) >= nr_towers:
+            break
+        tower = Tower('T%s' % (len(towers) + 1, ))
+        tower.position = Position(x, y)
+        tower.cover_road(level_map.road_offsets, tower_range)
+        offsets = [offset for offset in tower.road_offsets if offset < last]
+        if not offsets:
+            continue
+        tower.colors = dict((color, rnd.randint(1, 3))
+                            for color in rnd.sample(colors, rnd.randint(1, len(colors))))
+        tower.frame = len(towers)
+        tower.offsets = offsets
+        towers.append(tower)
+        actions.append(Action.new_tower(tower.frame, tower.id, (x, y),
+                                        tower.colors))
+
+    spawns = {}
+    health = {}
+    for bug in level.bugs:
+        spawns.setdefault(bug.frame, []).append(bug.id)
+        health[bug.id] = dict(bug.colors)
+    end = max(spawns) + last if spawns else 0
+    for frame in range(end):
+        shot = set()
+        for tower in towers:
+            if tower.frame > frame:
+                continue
+            candidates = [bug_id for offset in tower.offsets
+                          for bug_id in spawns.get(frame - offset, ())
+                          if bug_id in health]
+            if not candidates:
+                continue
+            bug_id = rnd.choice(candidates)
+            colors = health[bug_id]
+            for color, value in tower.colors.items():
+                colors[color] -= value
+            shot.add(bug_id)
+            actions.append(Action.shoot(frame, tower.id, bug_id))
+        # the same rules as the game: dead bugs are cleared, negative health
+        # becomes collateral damage
+        for bug_id in shot:
+            colors = health[bug_id]
+            if all(value <= 0 for value in colors.values()):
+                del health[bug_id]
+            else:
+                for color in colors:
+                    colors[color] = max(colors[color], 0)
+    # in frame order like a written solution, so it can also be streamed;
+    # the builds stay before the shots of their frame
+    actions.sort(key=lambda action: action.frame)
+    return actions
+
+
+def actions_text(actions):
+    game = TDGame(verbose=False)
+    game.actions = actions
+    f_out = io.StringIO()
+    game.dump_actions(f_out)
+    return f_out.getvalue()
+
+
+def load_case(case, seed=0):
+    level = TDGame().read_level(io.StringIO(generate_level(seed=seed, **case)))
+    return level, generate_actions(level, case['nr_towers'], seed)
+
+
+def new_game(level, actions, vectorized):
+    game = TDGame(verbose=False, vectorized=vectorized)
+    game.initialize_level(level)
+    game.actions = list(actions)
+    return game
+
+
+def run_case(case, vectorized=False, seed=0):
+    level, actions = load_case(case, seed)
+    frames = case['spawn_frames'] + case['road_length']
+
+    # plain run for the throughput
+    game = new_game(level, actions, vectorized)
+    start = timer()
+    result = game.run_to_completion(max_frames=frames)
+    seconds = timer() - start
+    nr_frames = game.frame + 1
+
+    # the same game again, with the phases timed
+    game = new_game(level, actions, vectorized)
+    profiler = PhaseProfiler()
+    profiler.enable(game)
+    game.run_to_completion(max_frames=frames)
+    profiler.disable()
+    phases = profiler.summary()['phases']
+
+    # and once more for the memory, tracing slows everything down
+    tracemalloc.start()
+    game = new_game(level, actions, vectorized)
+    game.run_to_completion(max_frames=frames)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'case': case,
+        'vectorized': vectorized,
+        'outcome': result.outcome,
+        'errors': len(game.errors),
+        'frames': nr_frames,
+        'seconds': seconds,
+        'fps': nr_frames / seconds if seconds else None,
+        'peak_mb': peak / 2.0 ** 20,
+        'phases': dict((name, phases[name]['mean']) for name in PHASES),
+    }
+
+
+def case_name(suite, value, vectorized):
+    return '%s=%s%s' % (suite, value, ' vectorized' if vectorized else '')
+
+
+def run_suites(suites, vectorized=False, scale=1.0, f_out=sys.stdout):
+    results = {}
+    for suite in suites:
+        dimension, values = SUITES[suite]
+        for value in values:
+            case = dict(BASE_CASE)
+            case[dimension] = value
+            if scale != 1.0:
+                case['nr_bugs'] = max(int(case['nr_bugs'] * scale), 1)
+                case['spawn_frames'] = max(int(case['spawn_frames'] * scale), 1)
+            name = case_name(suite, value, vectorized)
+            results[name] = run_case(case, vectorized)
+            print_result(name, results[name], f_out)
+    return results
+
+
+def print_result(name, result, f_out=sys.stdout):
+    slowest = max(result['phases'], key=result['phases'].get)
+    f_out.write('%-28s %8.1f fps %8.1f MB  %6s frames  slowest %s %.1f us\n' % (
+        name, result['fps'] or 0, result['peak_mb'], result['frames'],
+        slowest, result['phases'][slowest] * 1e6))
+    if result['errors']:
+        f_out.write('  %s invalid actions\n' % (result['errors'], ))
+
+
+def compare(results, baseline, f_out=sys.stdout):
+    # returns the names of the cases whose fps dropped below REGRESSION
+    # times their baseline
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base or not base['fps'] or not result['fps']:
+            continue
+        ratio = result['fps'] / base['fps']
+        flag = ''
+        if ratio < REGRESSION:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        f_out.write('%-28s %6.2fx fps  %6.2fx memory%s\n' % (
+            name, ratio, result['peak_mb'] / base['peak_mb'], flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate TD Game levels and measure how the engine scales.')
+    commands = parser.add_subparsers(dest='command')
+
+    generate = commands.add_parser('generate', help='write a level and a solution')
+    generate.add_argument('level')
+    generate.add_argument('solution')
+    for name, value in sorted(BASE_CASE.items()):
+        generate.add_argument('--' + name.replace('_', '-'), type=int,
+                              default=value)
+    generate.add_argument('--seed', type=int, default=0)
+
+    run = commands.add_parser('run', help='run the scaling suites')
+    run.add_argument('--suite', action='append', choices=sorted(SUITES))
+    run.add_argument('--vectorized', action='store_true')
+    run.add_argument('--scale', type=float, default=1.0,
+                     help='scale the number of bugs and spawn frames')
+    run.add_argument('--save', help='save the results as a baseline')
+    run.add_argument('--compare', help='compare with a saved baseline')
+
+    commands.add_parser('check', help='check the roads that touch themselves')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        case = dict((name, getattr(args, name)) for name in BASE_CASE)
+        text = generate_level(seed=args.seed, **case)
+        level = TDGame().read_level(io.StringIO(text))
+        with open(args.level, 'w') as f_level:
+            f_level.write(text)
+        with open(args.solution, 'w') as f_solution:
+            f_solution.write(actions_text(generate_actions(
+                level, args.nr_towers, args.seed)))
+    elif args.command == 'run':
+        results = run_suites(args.suite or sorted(SUITES), args.vectorized,
+                             args.scale)
+        if args.save:
+            with open(args.save, 'w') as f_save:
+                json.dump(results, f_save, indent=1, sort_keys=True)
+        if args.compare:
+            with open(args.compare) as f_baseline:
+                baseline = json.load(f_baseline)
+            if compare(results, baseline):
+                sys.exit(1)
+    elif args.command == 'check':
+        if check_roads():
+            sys.exit(1)
+    else:
+        parser.print_help()
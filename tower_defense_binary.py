@@ -0,0 +1,406 @@
+import argparse
+import mmap
+import struct
+
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from tower_defense import (Action, ActionReader, Bug, BugStore, Level, Map,
+                           Position, TDGame)
+
+# Binary level layout (little endian, every array starts 8 byte aligned):
+#   magic 'TDLV', version u32
+#   settings: count u32, then per setting a string and an i64 value
+#   colors: count u32, then one string per color
+#   bugs: count u32, ids as one '\n' joined string,
+#         frames i32[bugs], health i32[bugs x colors],
+#         u8[bugs x colors] 1 where the bug has the color (since version 2)
+#   map: rows u32, cols u32, one byte per cell
+#   bug road: length u32, i32[length x 2] as (x, y) pairs
+# Strings are stored as a u32 length followed by utf-8 bytes.
+LEVEL_MAGIC = b'TDLV'
+# Binary action log: magic 'TDAC', version u32, string table (count u32 and
+# strings), action count u32, then one record per action:
+#   frame i32, type u8, tower u32 (string index) and
+#   shoot: bug u32 (string index)
+#   new_tower: x i32, y i32, colors u16, (color u32, value i32) per color
+ACTIONS_MAGIC = b'TDAC'
+VERSION = 1
+LEVEL_VERSION = 2
+
+ACTION_TYPES = [Action.NEW_TOWER, Action.SHOOT]
+
+
+class BinaryFormatError(Exception):
+    pass
+
+
+class _Writer(object):
+    def __init__(self, f_out):
+        self.f_out = f_out
+        self.pos = 0
+
+    def write(self, data):
+        self.f_out.write(data)
+        self.pos += len(data)
+
+    def pack(self, fmt, *values):
+        self.write(struct.pack('<' + fmt, *values))
+
+    def string(self, value):
+        data = value.encode('utf-8')
+        self.pack('I', len(data))
+        self.write(data)
+
+    def align(self):
+        if self.pos % 8:
+            self.write(b'\0' * (8 - self.pos % 8))
+
+    def int32_array(self, values):
+        self.align()
+        self.write(struct.pack('<%si' % (len(values), ), *values))
+
+
+class _Reader(object):
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+
+    def unpack(self, fmt):
+        fmt = '<' + fmt
+        values = struct.unpack_from(fmt, self.buf, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return values
+
+    def string(self):
+        (length, ) = self.unpack('I')
+        value = bytes(self.buf[self.pos:self.pos + length]).decode('utf-8')
+        self.pos += length
+        return value
+
+    def align(self):
+        if self.pos % 8:
+            self.pos += 8 - self.pos % 8
+
+    def int32_array(self, count):
+        # a view on the buffer, nothing is copied
+        self.align()
+        start = self.pos
+        self.pos += 4 * count
+        if np is not None:
+            return np.frombuffer(self.buf, dtype='<i4', count=count,
+                                 offset=start)
+        return memoryview(self.buf)[start:self.pos].cast('i')
+
+    def bytes_view(self, count):
+        start = self.pos
+        self.pos += count
+        return memoryview(self.buf)[start:self.pos]
+
+
+class GridRow(Sequence):
+    # one row of a memory mapped grid, cells are decoded on access
+    def __init__(self, cells):
+        self.cells = cells
+
+    def __getitem__(self, x):
+        if isinstance(x, slice):
+            return [chr(cell) for cell in self.cells[x]]
+        return chr(self.cells[x])
+
+    def __len__(self):
+        return len(self.cells)
+
+
+class GridRows(Sequence):
+    def __init__(self, cells, nr_rows, nr_cols):
+        self.cells = cells
+        self.nr_rows = nr_rows
+        self.nr_cols = nr_cols
+
+    def __getitem__(self, y):
+        if isinstance(y, slice):
+            return [self[i] for i in range(*y.indices(self.nr_rows))]
+        if y < 0:
+            y += self.nr_rows
+        if y < 0 or y >= self.nr_rows:
+            raise IndexError(y)
+        start = y * self.nr_cols
+        return GridRow(self.cells[start:start + self.nr_cols])
+
+    def __len__(self):
+        return self.nr_rows
+
+
+class BinaryLevel(Level):
+    # a level backed by the memory mapped columns of a binary level file;
+    # present tells which colors every bug has, None when all of them
+    def __init__(self, settings, ids, colors, frames, health, level_map,
+                 buf=None, present=None):
+        self.settings = settings
+        self.ids = ids
+        self.colors = colors
+        self.frames = frames
+        self.health = health
+        self.present = present
+        self.map = level_map
+        # keeps the mapping open as long as the level is used
+        self.buf = buf
+
+    @property
+    def bugs(self):
+        # Bug definitions are only built when they are asked for
+        nr_colors = len(self.colors)
+        bugs = []
+        for i, bug_id in enumerate(self.ids):
+            bug = Bug(bug_id)
+            bug.frame = int(self.frames[i])
+            for c, color in enumerate(self.colors):
+                # a color the bug does not have is not a color at 0
+                if self.present is not None and not self.present[i * nr_colors + c]:
+                    continue
+                bug.colors[color] = int(self.health[i * nr_colors + c])
+            bugs.append(bug)
+        return bugs
+
+    def new_bugs(self):
+        return dict((bug.id, bug) for bug in self.bugs)
+
+    def new_bug_store(self, road):
+        if np is None:
+            raise Exception('numpy is required for the vectorized bug store')
+        health = np.asarray(self.health).reshape(len(self.ids),
+                                                 len(self.colors))
+        present = None
+        if self.present is not None:
+            present = np.frombuffer(self.present, dtype=np.uint8)
+        return BugStore(self.ids, self.colors, health, self.frames, road,
+                        present)
+
+
+def write_level(level, f_out):
+    writer = _Writer(f_out)
+    writer.write(LEVEL_MAGIC)
+    writer.pack('I', LEVEL_VERSION)
+
+    writer.pack('I', len(level.settings))
+    for name, value in level.settings.items():
+        writer.string(name)
+        writer.pack('q', value)
+
+    bugs = level.bugs
+    colors = set()
+    for bug in bugs:
+        colors.update(bug.colors)
+    colors = sorted(colors)
+    writer.pack('I', len(colors))
+    for color in colors:
+        writer.string(color)
+
+    writer.pack('I', len(bugs))
+    writer.string('\n'.join(bug.id for bug in bugs))
+    writer.int32_array([bug.frame for bug in bugs])
+    writer.int32_array([bug.colors.get(color, 0)
+                        for bug in bugs for color in colors])
+    writer.write(bytes(bytearray(int(color in bug.colors)
+                                 for bug in bugs for color in colors)))
+
+    rows = level.map.rows
+    nr_cols = len(rows[0]) if len(rows) else 0
+    writer.pack('II', len(rows), nr_cols)
+    cells = bytearray()
+    for row in rows:
+        if len(row) != nr_cols:
+            raise BinaryFormatError('All the map rows must have the same length')
+        for cell in row:
+            if len(cell) != 1:
+                raise BinaryFormatError('Map cells must be one character, '
+                                        'got %r' % (cell, ))
+            cells.extend(cell.encode('ascii'))
+    writer.write(bytes(cells))
+
+    road = level.map.bug_road
+    writer.pack('I', len(road))
+    writer.int32_array([val for pos in road for val in (pos.x, pos.y)])
+    f_out.flush()
+
+
+def read_level(buf):
+    reader = _Reader(buf)
+    magic = bytes(reader.bytes_view(4))
+    if magic != LEVEL_MAGIC:
+        raise BinaryFormatError('Not a binary level file')
+    (version, ) = reader.unpack('I')
+    if version not in (1, LEVEL_VERSION):
+        raise BinaryFormatError('Unsupported level version %s' % (version, ))
+
+    settings = {}
+    (nr_settings, ) = reader.unpack('I')
+    for i in range(nr_settings):
+        name = reader.string()
+        (settings[name], ) = reader.unpack('q')
+
+    (nr_colors, ) = reader.unpack('I')
+    colors = [reader.string() for i in range(nr_colors)]
+
+    (nr_bugs, ) = reader.unpack('I')
+    ids = reader.string().split('\n') if nr_bugs else []
+    frames = reader.int32_array(nr_bugs)
+    health = reader.int32_array(nr_bugs * nr_colors)
+    # version 1 files give every bug all the colors
+    present = None
+    if version >= 2:
+        present = reader.bytes_view(nr_bugs * nr_colors)
+
+    nr_rows, nr_cols = reader.unpack('II')
+    rows = GridRows(reader.bytes_view(nr_rows * nr_cols), nr_rows, nr_cols)
+
+    (road_length, ) = reader.unpack('I')
+    coords = reader.int32_array(road_length * 2)
+    road = [Position(int(coords[2 * i]), int(coords[2 * i + 1]))
+            for i in range(road_length)]
+
+    return BinaryLevel(settings, ids, colors, frames, health,
+                       Map(rows, bug_road=road), buf, present)
+
+
+def load_level(path):
+    # the grid and the bug columns stay in the mapped file
+    with open(path, 'rb') as f_in:
+        buf = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+    return read_level(buf)
+
+
+def write_level_text(level, f_out):
+    for name, value in level.settings.items():
+        f_out.write('%s=%s\n' % (name, value))
+    # the settings reader consumes the line after the settings
+    f_out.write('\n')
+    for bug in level.bugs:
+        attrs = ['%s=%s' % (color, value) for color, value in bug.colors.items()]
+        attrs.append('frame=%s' % (bug.frame, ))
+        f_out.write('%s %s\n' % (bug.id, ' '.join(attrs)))
+    f_out.write('\n')
+    for row in level.map.rows:
+        f_out.write(' '.join(row) + '\n')
+    f_out.flush()
+
+
+def level_text_to_binary(f_text, f_binary):
+    write_level(TDGame().read_level(f_text), f_binary)
+
+
+def level_binary_to_text(path, f_text):
+    write_level_text(load_level(path), f_text)
+
+
+def write_actions(actions, f_out):
+    strings = []
+    string_index = {}
+
+    def index(value):
+        i = string_index.get(value)
+        if i is None:
+            i = string_index[value] = len(strings)
+            strings.append(value)
+        return i
+
+    records = []
+    nr_actions = 0
+    for action in actions:
+        record = [struct.pack('<iBI', action.frame,
+                              ACTION_TYPES.index(action.action_type),
+                              index(action.tower_id))]
+        if action.action_type == Action.SHOOT:
+            record.append(struct.pack('<I', index(action.bug_id)))
+        else:
+            x, y = action.position
+            record.append(struct.pack('<iiH', x, y, len(action.colors)))
+            for color, value in action.colors.items():
+                record.append(struct.pack('<Ii', index(color), value))
+        records.append(b''.join(record))
+        nr_actions += 1
+
+    writer = _Writer(f_out)
+    writer.write(ACTIONS_MAGIC)
+    writer.pack('I', VERSION)
+    writer.pack('I', len(strings))
+    for value in strings:
+        writer.string(value)
+    writer.pack('I', nr_actions)
+    for record in records:
+        writer.write(record)
+    f_out.flush()
+
+
+def read_actions(buf):
+    # yields the actions one at a time, in file order
+    reader = _Reader(buf)
+    magic = bytes(reader.bytes_view(4))
+    if magic != ACTIONS_MAGIC:
+        raise BinaryFormatError('Not a binary action file')
+    (version, ) = reader.unpack('I')
+    if version != VERSION:
+        raise BinaryFormatError('Unsupported action version %s' % (version, ))
+    (nr_strings, ) = reader.unpack('I')
+    strings = [reader.string() for i in range(nr_strings)]
+    (nr_actions, ) = reader.unpack('I')
+    for i in range(nr_actions):
+        frame, action_type, tower = reader.unpack('iBI')
+        if action_type >= len(ACTION_TYPES):
+            raise BinaryFormatError('Unknown action type %s' % (action_type, ))
+        if ACTION_TYPES[action_type] == Action.SHOOT:
+            (bug, ) = reader.unpack('I')
+            yield Action.shoot(frame, strings[tower], strings[bug])
+        else:
+            x, y, nr_colors = reader.unpack('iiH')
+            colors = {}
+            for c in range(nr_colors):
+                color, value = reader.unpack('Ii')
+                colors[strings[color]] = value
+            yield Action.new_tower(frame, strings[tower], (x, y), colors)
+
+
+def load_actions(path):
+    with open(path, 'rb') as f_in:
+        buf = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+    return list(read_actions(buf))
+
+
+def actions_text_to_binary(f_text, f_binary):
+    write_actions(ActionReader(f_text), f_binary)
+
+
+def actions_binary_to_text(path, f_text):
+    game = TDGame(verbose=False)
+    game.actions = load_actions(path)
+    game.dump_actions(f_text)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert TD Game levels and solutions between the text '
+                    'and the binary formats.')
+    parser.add_argument('kind', choices=['level', 'actions'])
+    parser.add_argument('direction', choices=['to-binary', 'to-text'])
+    parser.add_argument('source')
+    parser.add_argument('target')
+    args = parser.parse_args()
+
+    if args.direction == 'to-binary':
+        convert = {'level': level_text_to_binary,
+                   'actions': actions_text_to_binary}[args.kind]
+        with open(args.source) as f_text, open(args.target, 'wb') as f_binary:
+            convert(f_text, f_binary)
+    else:
+        convert = {'level': level_binary_to_text,
+                   'actions': actions_binary_to_text}[args.kind]
+        with open(args.target, 'w') as f_text:
+            convert(args.source, f_text)
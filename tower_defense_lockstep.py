@@ -0,0 +1,340 @@
+import argparse
+import itertools
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from tower_defense import (Action, GameResult, Position, TDGame, Tower,
+                           group_by_frame)
+
+SETTINGS = ['starting_life', 'starting_money', 'tower_range', 'tower_cost',
+            'reward_per_bug']
+
+
+class Variant(object):
+    # one game of a lockstep batch: settings that replace the level ones
+    # and its own actions
+    def __init__(self, settings=None, actions=None):
+        self.settings = settings or {}
+        self.actions = actions or []
+
+
+class LockstepGame(object):
+    # plays B variants of a level in lockstep with the rules of TDGame: the
+    # bugs walk the same road in all of them, so their offsets are shared and
+    # health, life and money get a leading variant dimension; a variant stops
+    # when it is won, lost or out of bugs and the others go on
+    def __init__(self, level, variants):
+        if np is None:
+            raise Exception('numpy is required for the lockstep game')
+        self.level = level
+        self.map = level.map
+        self.variants = variants
+        nr_variants = len(variants)
+
+        # the store sorts the bugs by spawn frame and finds the pending ones
+        store = level.new_bug_store(self.map.bug_road)
+        self.ids = store.ids
+        self.index = store.index
+        self.colors = store.colors
+        self.color_index = store.color_index
+        self.frame_of = store.frame
+        self.pending = store.pending
+        nr_bugs = len(self.ids)
+        self.health = np.repeat(store.health[None], nr_variants, axis=0)
+        self.present = store.present
+        self.offset = np.full(nr_bugs, -1, dtype=np.int64)
+        self.alive = np.ones((nr_variants, nr_bugs), dtype=bool)
+        self.lo = 0
+        self.hi = 0
+
+        settings = [dict(level.settings, **variant.settings)
+                    for variant in variants]
+        for name in SETTINGS:
+            setattr(self, name, np.array([s.get(name) for s in settings],
+                                         dtype=np.int64))
+        self.life = self.starting_life.copy()
+        self.money = self.starting_money.copy()
+        self.bugs_killed = np.zeros(nr_variants, dtype=np.int64)
+        self.bugs_escaped = np.zeros(nr_variants, dtype=np.int64)
+        self.remaining = np.full(nr_variants, nr_bugs, dtype=np.int64)
+        self.running = np.ones(nr_variants, dtype=bool)
+        self.results = [None] * nr_variants
+
+        # errors are logged once per action for all the variants it failed
+        # in, as (frame, variants, message)
+        self.error_log = []
+        self.nr_errors = np.zeros(nr_variants, dtype=np.int64)
+        self.first_error = [None] * nr_variants
+        self.error_frame = np.full(nr_variants, -1, dtype=np.int64)
+        # variants with the same action list are one group and play each of
+        # its actions together
+        groups = {}
+        for v, variant in enumerate(variants):
+            groups.setdefault(id(variant.actions), []).append(v)
+        self.groups = [(group_by_frame(variants[members[0]].actions),
+                        np.array(members))
+                       for members in groups.values()]
+
+        self.towers = [{} for variant in variants]
+        # {(x, y): tower id} per variant
+        self.tower_cells = [{} for variant in variants]
+        # one column per tower id: is it built, the road offsets it covers
+        # and the damage of its shots, per variant
+        tower_ids = set(action.tower_id
+                        for members in groups.values()
+                        for action in variants[members[0]].actions
+                        if action.action_type == Action.NEW_TOWER)
+        self.tower_columns = dict((tower_id, t)
+                                  for t, tower_id in enumerate(sorted(tower_ids)))
+        nr_towers = len(self.tower_columns)
+        self.has_tower = np.zeros((nr_variants, nr_towers), dtype=bool)
+        self.cover = np.zeros((nr_variants, nr_towers, len(self.map.bug_road)),
+                              dtype=bool)
+        self.tower_damage = np.zeros((nr_variants, nr_towers, len(self.colors)),
+                                     dtype=np.int64)
+        self.tower_has = np.zeros(self.tower_damage.shape, dtype=bool)
+        self.shot = np.zeros((nr_variants, nr_towers), dtype=bool)
+        self.frame = -1
+
+    def _error(self, v, message):
+        self._errors(np.array([v]), message)
+
+    def _errors(self, variants, message):
+        if not len(variants):
+            return
+        for v in variants[self.nr_errors[variants] == 0]:
+            self.first_error[v] = message
+            self.error_frame[v] = self.frame
+        self.nr_errors[variants] += 1
+        self.error_log.append((self.frame, variants, message))
+
+    def errors(self, v):
+        # the error messages of one variant, like TDGame.errors
+        return [message for frame, variants, message in self.error_log
+                if v in variants]
+
+    def _finish(self, v, outcome):
+        self.running[v] = False
+        error_frame = self.error_frame[v]
+        self.results[v] = GameResult(outcome, self.frame, int(self.life[v]),
+                                     int(self.money[v]),
+                                     int(self.bugs_killed[v]),
+                                     self.first_error[v],
+                                     int(error_frame) if error_frame >= 0 else None)
+
+    def run_to_completion(self, render_every=None, max_frames=None):
+        # same arguments as TDGame.run_to_completion
+        if render_every:
+            raise Exception('The lockstep engine does not render the variants')
+        while self.running.any():
+            if max_frames is not None and self.frame + 1 >= max_frames:
+                for v in np.flatnonzero(self.running):
+                    self._finish(v, GameResult.OUT_OF_FRAMES)
+                break
+            self.next_step()
+        return self.results
+
+    def next_step(self):
+        self.frame += 1
+        for frames, members in self.groups:
+            actions = frames.get(self.frame)
+            if actions and any(action.action_type == Action.NEW_TOWER
+                               for action in actions):
+                for v in members[self.running[members]]:
+                    self._build_towers(v, actions)
+
+        # the bugs move the same way in every variant
+        last = len(self.map.bug_road) - 1
+        lo, hi = self.lo, self.hi
+        np.minimum(self.offset[lo:hi] + 1, last, out=self.offset[lo:hi])
+        spawned = np.arange(hi, np.searchsorted(self.frame_of, self.frame,
+                                                side='right'))
+        self.offset[spawned] = 0
+        self.hi = hi = hi + len(spawned)
+
+        shot = self._shoot()
+
+        # a bug can only die or get a negative health on the frame it spawns
+        # or is shot, and it reaches the end of the road `last` frames after
+        # it spawned; only these rows are looked at
+        arrived = np.arange(*np.searchsorted(self.frame_of,
+                                             [self.frame - last,
+                                              self.frame - last + 1]))
+        rows = np.unique(np.concatenate([spawned, arrived, shot,
+                                         self.pending]).astype(np.int64))
+        health = self.health[:, rows]
+        alive = self.alive[:, rows]
+        finished = (self.offset[rows] == last)[None, :] & alive
+        dead = alive & np.all(health <= 0, axis=2)
+
+        # damage: the bugs that finished the road and the negative health
+        damage = np.where(finished[:, :, None], np.clip(health, 0, None),
+                          0).sum(axis=(1, 2))
+        damage -= np.where(alive[:, :, None], np.clip(health, None, 0),
+                           0).sum(axis=(1, 2))
+        np.clip(health, 0, None, out=health, where=alive[:, :, None])
+        self.health[:, rows] = health
+        self.life[self.running] -= damage[self.running]
+        for v in np.flatnonzero(self.running & (self.life <= 0)):
+            self._finish(v, GameResult.LOST)
+
+        nr_dead = dead.sum(axis=1)
+        self.money[self.running] += (self.reward_per_bug * nr_dead)[self.running]
+        self.bugs_killed[self.running] += nr_dead[self.running]
+        won = (self.bugs_escaped == 0) & (nr_dead == self.remaining)
+
+        # clear the dead bugs and retire the ones that finished the road
+        gone = dead | finished
+        self.bugs_escaped += (finished & ~dead).sum(axis=1)
+        self.remaining -= gone.sum(axis=1)
+        self.alive[:, rows] = alive & ~gone
+        self.pending = self.pending[:0]
+        # the window starts at the oldest bug alive in any variant
+        while self.lo < hi and not self.alive[:, self.lo].any():
+            self.lo += 1
+
+        for v in np.flatnonzero(self.running):
+            if won[v]:
+                self._finish(v, GameResult.WON)
+            elif self.remaining[v] == 0:
+                self._finish(v, GameResult.OUT_OF_BUGS)
+
+    def _build_towers(self, v, actions):
+        if not actions:
+            return
+        towers = self.towers[v]
+        cells = self.tower_cells[v]
+        for action in actions:
+            if action.action_type != Action.NEW_TOWER:
+                continue
+            tower_id = action.tower_id
+            if tower_id in towers:
+                self._error(v, 'There is already a tower with the same id %s' % (tower_id,))
+                return
+            pos = Position(action.position[0], action.position[1])
+            if not self.map.check_tower_pos(pos.x, pos.y):
+                self._error(v, 'Can not build a tower on position %s' % (pos,))
+                return
+            if (pos.x, pos.y) in cells:
+                self._error(v, 'Tower is already build on position %s' % (pos,))
+            if self.money[v] < self.tower_cost[v]:
+                self._error(v, 'not enought resources to build a tower')
+                return
+            self.money[v] -= self.tower_cost[v]
+
+            tower = Tower(tower_id)
+            tower.colors = dict(action.colors)
+            tower.position = pos
+            tower.cover_road(self.map.road_offsets, int(self.tower_range[v]))
+            t = self.tower_columns[tower_id]
+            self.has_tower[v, t] = True
+            self.cover[v, t] = False
+            self.cover[v, t, tower.road_offsets] = True
+            self.tower_damage[v, t] = 0
+            self.tower_has[v, t] = False
+            for color, value in tower.colors.items():
+                if color not in self.color_index:
+                    raise Exception('No bug has the color %s of tower %s' % (
+                        color, tower_id))
+                self.tower_damage[v, t, self.color_index[color]] = value
+                self.tower_has[v, t, self.color_index[color]] = True
+            towers[tower_id] = tower
+            cells[(pos.x, pos.y)] = tower_id
+
+    def _shoot(self):
+        # every action is checked and played for all the variants of its
+        # group at once, the errors are the ones TDGame would log; returns
+        # the bugs that were hit
+        shot = []
+        for frames, members in self.groups:
+            actions = frames.get(self.frame)
+            if not actions:
+                continue
+            variants = members[self.running[members]]
+            if not len(variants):
+                continue
+            self.shot[variants] = False
+            for action in actions:
+                if action.action_type != Action.SHOOT:
+                    continue
+                tower_id = action.tower_id
+                bug_id = action.bug_id
+                t = self.tower_columns.get(tower_id)
+                i = self.index.get(bug_id)
+                if t is None:
+                    already_shot = np.zeros(len(variants), dtype=bool)
+                    valid = np.zeros(len(variants), dtype=bool)
+                else:
+                    already_shot = self.shot[variants, t]
+                    valid = self.has_tower[variants, t]
+                self._errors(variants[already_shot],
+                             'This tower already shot: %s' % (tower_id,))
+                if i is None or self.offset[i] < 0:
+                    valid[:] = False
+                else:
+                    valid &= self.alive[variants, i]
+                self._errors(variants[~valid],
+                             'no such tower or bug on map (%s - %s)' % (tower_id, bug_id))
+                hit = variants[valid]
+                if not len(hit):
+                    continue
+                in_range = self.cover[hit, t, self.offset[i]]
+                self._errors(hit[~in_range],
+                             'bug not in range of tower (%s - %s)' % (bug_id, tower_id))
+                # the bug needs all the colors of the tower
+                has_colors = ~np.any(self.tower_has[hit, t] & ~self.present[i],
+                                     axis=1)
+                self._errors(hit[~has_colors],
+                             'bug does not have the colors of tower (%s - %s)' % (
+                                 bug_id, tower_id))
+                hit = hit[has_colors]
+                if not len(hit):
+                    continue
+                self.health[hit, i] -= self.tower_damage[hit, t]
+                self.shot[hit, t] = True
+                shot.append(i)
+        return shot
+
+
+def sweep(level, actions, **values):
+    # one variant per combination of the given setting values, all playing
+    # the same actions
+    names = sorted(values)
+    variants = []
+    for combination in itertools.product(*[values[name] for name in names]):
+        variants.append(Variant(dict(zip(names, combination)), actions))
+    return variants
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Play one solution with many settings in lockstep.')
+    parser.add_argument('level')
+    parser.add_argument('solution')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='NAME=V1,V2,...',
+                        help='values of a setting to sweep, e.g. tower_cost=5,10')
+    parser.add_argument('--max-frames', type=int, default=None)
+    args = parser.parse_args()
+
+    game = TDGame()
+    with open(args.level) as f_in:
+        level = game.read_level(f_in)
+    with open(args.solution) as f_actions:
+        actions = game._read_actions(f_actions)
+    values = {}
+    for item in args.set:
+        name, vals = item.split('=')
+        if name not in SETTINGS:
+            parser.error('unknown setting %s' % (name, ))
+        values[name] = [int(val) for val in vals.split(',')]
+    variants = sweep(level, actions, **values)
+    results = LockstepGame(level, variants).run_to_completion(
+        max_frames=args.max_frames)
+    for variant, result in zip(variants, results):
+        print('%s  %s' % (' '.join('%s=%s' % item
+                                   for item in sorted(variant.settings.items())),
+                          result))
@@ -0,0 +1,212 @@
+import argparse
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from tower_defense import TDGame
+
+
+class CoverageMatrix(object):
+    # candidate cell x road offset: the road cells every free cell covers
+    # with the given tower range, the same square Tower.cover_road uses.
+    # Only the cells next to the road are candidates and the matrix is kept
+    # as (candidate, offset) pairs sorted by candidate.
+    def __init__(self, level_map, tower_range):
+        road = level_map.bug_road
+        self.nr_offsets = len(road)
+        nr_rows = level_map.number_of_rows()
+        nr_cols = level_map.number_of_cols()
+        road_x = np.array([pos.x for pos in road], dtype=np.int64)
+        road_y = np.array([pos.y for pos in road], dtype=np.int64)
+        is_road = np.zeros(nr_rows * nr_cols, dtype=bool)
+        is_road[road_y * nr_cols + road_x] = True
+
+        cells = []
+        offsets = []
+        road_offsets = np.arange(len(road), dtype=np.int64)
+        for dy in range(-tower_range, tower_range + 1):
+            for dx in range(-tower_range, tower_range + 1):
+                x = road_x + dx
+                y = road_y + dy
+                inside = (x >= 0) & (x < nr_cols) & (y >= 0) & (y < nr_rows)
+                cell = y[inside] * nr_cols + x[inside]
+                # the towers are not built on the road
+                free = ~is_road[cell]
+                cells.append(cell[free])
+                offsets.append(road_offsets[inside][free])
+        cells = np.concatenate(cells)
+        offsets = np.concatenate(offsets)
+        order = np.lexsort((offsets, cells))
+        cells = cells[order]
+        self.offsets = offsets[order]
+        # row of every pair, the candidates are the distinct cells
+        cell_ids, self.rows = np.unique(cells, return_inverse=True)
+        self.rows = self.rows.reshape(-1)
+        self.cells = np.stack([cell_ids % nr_cols, cell_ids // nr_cols], axis=1)
+        self.size = np.bincount(self.rows, minlength=len(cell_ids))
+        # the offsets are sorted in every row, so its first pair holds the
+        # first offset the candidate covers
+        self.first = self.offsets[np.concatenate([[0], np.cumsum(self.size)[:-1]])]
+
+    def __len__(self):
+        return len(self.cells)
+
+    def dense(self):
+        matrix = np.zeros((len(self.cells), self.nr_offsets), dtype=bool)
+        matrix[self.rows, self.offsets] = True
+        return matrix
+
+    def weigh(self, weights):
+        # sum of the weights of the offsets covered by every candidate
+        return np.bincount(self.rows, weights=weights[self.offsets],
+                           minlength=len(self.cells))
+
+
+def bug_flow(bugs, road_length, colors, max_frames=None):
+    # traffic: the number of bugs that walk over each road offset, and the
+    # health of every color they carry there; with max_frames the bugs that
+    # spawn too late do not reach the end of the road
+    frames = np.array(sorted(bug.frame for bug in bugs), dtype=np.int64)
+    health = np.array([[bug.colors.get(color, 0) for color in colors]
+                       for bug in sorted(bugs, key=lambda bug: bug.frame)],
+                      dtype=np.int64).reshape(len(frames), len(colors))
+    health = np.clip(health, 0, None)
+    if max_frames is None:
+        traffic = np.full(road_length, len(frames), dtype=np.int64)
+        flow = np.repeat(health.sum(axis=0)[None], road_length, axis=0)
+        return traffic, flow
+    # a bug spawned at frame f is on offset o at frame f + o
+    traffic = np.searchsorted(frames, max_frames - np.arange(road_length))
+    totals = np.concatenate([np.zeros((1, len(colors)), dtype=np.int64),
+                             np.cumsum(health, axis=0)])
+    return traffic, totals[traffic]
+
+
+class PlacementOptimizer(object):
+    # picks the cells to build on before the first frame. The damage
+    # potential of a tower is the health it can take from the bugs passing
+    # the first offset it covers: one shot per frame with a bug in range, at
+    # most its power per color. The cells are picked greedily by that
+    # potential; the health a tower takes is removed from the flow of the
+    # offsets after it, so the next towers are scored on what is left.
+    def __init__(self, level, colors, budget=None, max_towers=None,
+                 max_frames=None):
+        if np is None:
+            raise Exception('numpy is required for the placement optimizer')
+        self.level = level
+        self.settings = level.settings
+        # the colors and power of every new tower
+        self.colors = colors
+        self.color_names = sorted(colors)
+        self.power = np.array([colors[color] for color in self.color_names],
+                              dtype=np.int64)
+        if budget is None:
+            budget = self.settings.get('starting_money')
+        self.max_towers = budget // self.settings.get('tower_cost')
+        if max_towers is not None:
+            self.max_towers = min(self.max_towers, max_towers)
+        self.max_frames = max_frames
+
+        road = level.map.bug_road
+        self.coverage = CoverageMatrix(level.map, self.settings.get('tower_range'))
+        self.traffic, self.flow = bug_flow(level.bugs, len(road),
+                                           self.color_names, max_frames)
+        # a tower shoots at most once per frame, while the bugs of a spawn
+        # frame walk over the offsets it covers
+        spawn_frames = len(set(bug.frame for bug in level.bugs))
+        self.shots = np.minimum(self.coverage.weigh(self.traffic).astype(np.int64),
+                                self.coverage.size * spawn_frames)
+
+    def potential(self, flow):
+        # damage potential of every candidate for the health left in flow
+        reach = flow[self.coverage.first]
+        damage = np.minimum(self.shots[:, None] * self.power[None], reach)
+        return damage.sum(axis=1), damage
+
+    def choose(self):
+        # [((x, y), damage potential)] in the order they were picked
+        flow = self.flow.copy()
+        free = np.ones(len(self.coverage), dtype=bool)
+        chosen = []
+        while len(chosen) < self.max_towers:
+            gain, damage = self.potential(flow)
+            gain[~free] = -1
+            best = int(np.argmax(gain)) if len(gain) else -1
+            if best < 0 or gain[best] <= 0:
+                break
+            free[best] = False
+            flow[self.coverage.first[best]:] -= damage[best]
+            np.clip(flow, 0, None, out=flow)
+            x, y = self.coverage.cells[best]
+            chosen.append(((int(x), int(y)), int(gain[best])))
+        return chosen
+
+    def add_builds(self, game, prefix='T'):
+        # the chosen cells as action_new_tower actions of a started game,
+        # built on its next frame
+        used = set(action.tower_id for action in game.actions)
+        number = 0
+        placements = self.choose()
+        for position, gain in placements:
+            number += 1
+            while '%s%s' % (prefix, number) in used:
+                number += 1
+            game.action_new_tower('%s%s' % (prefix, number), position,
+                                  dict(self.colors))
+        return placements
+
+
+def common_colors(bugs):
+    # the colors every bug has, a tower shooting any other color is invalid
+    colors = None
+    for bug in bugs:
+        if colors is None:
+            colors = set(bug.colors)
+        else:
+            colors &= set(bug.colors)
+    return sorted(colors or [])
+
+
+def place_towers(level_path, f_solution=None, colors=None, budget=None,
+                 max_towers=None, max_frames=None):
+    game = TDGame(verbose=False)
+    with open(level_path) as f_in:
+        game.initialize(f_in)
+    if not colors:
+        colors = dict((color, 1) for color in common_colors(game.level.bugs))
+    optimizer = PlacementOptimizer(game.level, colors, budget, max_towers,
+                                   max_frames)
+    game.start_simulation()
+    placements = optimizer.add_builds(game)
+    if f_solution:
+        game.dump_actions(f_solution)
+    return placements, game.actions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Choose where to build the towers of a TD Game level.')
+    parser.add_argument('level')
+    parser.add_argument('solution', help='the builds are written here')
+    parser.add_argument('--color', action='append', default=[],
+                        metavar='COLOR=POWER',
+                        help='a color of the new towers, all the colors of '
+                             'the bugs with power 1 by default')
+    parser.add_argument('--budget', type=int, default=None,
+                        help='money to spend, starting_money by default')
+    parser.add_argument('--max-towers', type=int, default=None)
+    parser.add_argument('--max-frames', type=int, default=None)
+    args = parser.parse_args()
+
+    colors = {}
+    for item in args.color:
+        color, power = item.split('=')
+        colors[color] = int(power)
+    with open(args.solution, 'w') as f_solution:
+        placements, actions = place_towers(args.level, f_solution, colors,
+                                           args.budget, args.max_towers,
+                                           args.max_frames)
+    for position, gain in placements:
+        print('%s,%s damage potential %s' % (position[0], position[1], gain))
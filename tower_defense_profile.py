@@ -0,0 +1,175 @@
+import argparse
+import csv
+import json
+import sys
+import time
+
+from tower_defense import TDGame
+
+# the phases of TDGame.next_step, in the order they run
+PHASES = ['_build_towers', '_move_bugs', '_put_bugs_on_map', '_shoot',
+          '_check_dead_bugs', '_compute_damage', '_check_life',
+          '_give_rewards', '_check_game_finished', '_clear_bugs']
+COUNTERS = ['bugs_alive', 'shots_fired', 'towers_built', 'bugs_cleared']
+FRAME_COLUMNS = ['frame', 'total'] + PHASES + COUNTERS
+SUMMARY_COLUMNS = ['phase', 'total', 'mean', 'max', 'share']
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class PhaseProfiler(object):
+    # times the phases of TDGame.next_step and counts what happens on every
+    # frame; enable() wraps the methods of one game and disable() removes the
+    # wrappers, so a game that is not profiled does not pay anything
+    def __init__(self):
+        self.game = None
+        # one row per frame, times are in seconds
+        self.frames = []
+        self.current = None
+
+    def enable(self, game):
+        if self.game is not None:
+            raise Exception('The profiler is already enabled')
+        self.game = game
+        for name in PHASES:
+            setattr(game, name, self._timed(name, getattr(game, name)))
+        game._apply_shot = self._counted(game._apply_shot)
+        game.next_step = self._frame(game.next_step)
+
+    def disable(self):
+        if self.game is None:
+            return
+        # the class methods are visible again
+        for name in PHASES + ['_apply_shot', 'next_step']:
+            self.game.__dict__.pop(name, None)
+        self.game = None
+
+    def reset(self):
+        self.frames = []
+
+    def _frame(self, next_step):
+        def profiled_next_step():
+            game = self.game
+            if not game.simulation_started:
+                return next_step()
+            row = dict.fromkeys(FRAME_COLUMNS, 0)
+            nr_bugs = game.bug_counts()[1]
+            nr_towers = len(game.towers)
+            self.current = row
+            start = timer()
+            try:
+                return next_step()
+            finally:
+                row['total'] = timer() - start
+                row['frame'] = game.frame
+                # bugs on the map, the ones waiting to enter are not alive yet
+                on_map, remaining = game.bug_counts()
+                row['bugs_alive'] = on_map
+                row['towers_built'] = len(game.towers) - nr_towers
+                row['bugs_cleared'] = nr_bugs - remaining
+                self.current = None
+                self.frames.append(row)
+        return profiled_next_step
+
+    def _timed(self, name, phase):
+        def timed_phase(*args):
+            start = timer()
+            try:
+                return phase(*args)
+            finally:
+                if self.current is not None:
+                    self.current[name] += timer() - start
+        return timed_phase
+
+    def _counted(self, apply_shot):
+        def counted_apply_shot(tower, bug):
+            if self.current is not None:
+                self.current['shots_fired'] += 1
+            return apply_shot(tower, bug)
+        return counted_apply_shot
+
+    def summary(self):
+        # the whole game: time per phase and the counter totals
+        frames = self.frames
+        total = sum(row['total'] for row in frames)
+        phases = {}
+        for name in PHASES + ['total']:
+            times = [row[name] for row in frames]
+            phases[name] = {
+                'total': sum(times),
+                'mean': sum(times) / len(times) if times else 0,
+                'max': max(times) if times else 0,
+                'share': sum(times) / total if total else 0,
+            }
+        counters = dict((name, sum(row[name] for row in frames))
+                        for name in COUNTERS if name != 'bugs_alive')
+        counters['max_bugs_alive'] = max([row['bugs_alive'] for row in frames]
+                                         or [0])
+        return {'frames': len(frames), 'phases': phases, 'counters': counters}
+
+    def write_json(self, f_out):
+        json.dump({'game': self.summary(), 'frames': self.frames}, f_out,
+                  indent=1)
+
+    def write_csv(self, f_out):
+        writer = csv.writer(f_out)
+        writer.writerow(FRAME_COLUMNS)
+        for row in self.frames:
+            writer.writerow([row[name] for name in FRAME_COLUMNS])
+
+    def write_summary_csv(self, f_out):
+        phases = self.summary()['phases']
+        writer = csv.writer(f_out)
+        writer.writerow(SUMMARY_COLUMNS)
+        for name in PHASES + ['total']:
+            writer.writerow([name] + [phases[name][column]
+                                      for column in SUMMARY_COLUMNS[1:]])
+
+    def print_summary(self, f_out=sys.stdout):
+        summary = self.summary()
+        f_out.write('%s frames\n' % (summary['frames'], ))
+        f_out.write('%-22s %12s %12s %12s %7s\n' % (
+            'phase', 'total ms', 'mean us', 'max us', 'share'))
+        for name in PHASES + ['total']:
+            phase = summary['phases'][name]
+            f_out.write('%-22s %12.3f %12.1f %12.1f %6.1f%%\n' % (
+                name, phase['total'] * 1e3, phase['mean'] * 1e6,
+                phase['max'] * 1e6, phase['share'] * 100))
+        for name, value in sorted(summary['counters'].items()):
+            f_out.write('%s: %s\n' % (name, value))
+
+
+def profile_game(level_path, actions_path, vectorized=False, max_frames=None):
+    game = TDGame(verbose=False, vectorized=vectorized)
+    with open(level_path) as f_in, open(actions_path) as f_actions:
+        game.initialize(f_in, f_actions)
+    profiler = PhaseProfiler()
+    profiler.enable(game)
+    try:
+        result = game.run_to_completion(max_frames=max_frames)
+    finally:
+        profiler.disable()
+    return result, profiler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time the phases of a TD Game solution.')
+    parser.add_argument('level')
+    parser.add_argument('solution')
+    parser.add_argument('--vectorized', action='store_true')
+    parser.add_argument('--max-frames', type=int, default=None)
+    parser.add_argument('--json', help='write the frames and the summary here')
+    parser.add_argument('--csv', help='write one row per frame here')
+    args = parser.parse_args()
+
+    result, profiler = profile_game(args.level, args.solution,
+                                    args.vectorized, args.max_frames)
+    print(result)
+    profiler.print_summary()
+    if args.json:
+        with open(args.json, 'w') as f_json:
+            profiler.write_json(f_json)
+    if args.csv:
+        with open(args.csv, 'w') as f_csv:
+            profiler.write_csv(f_csv)
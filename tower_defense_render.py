@@ -0,0 +1,134 @@
+import shutil
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from tower_defense import BugView
+
+CLEAR_SCREEN = '\x1b[2J'
+HIDE_CURSOR = '\x1b[?25l'
+SHOW_CURSOR = '\x1b[?25h'
+STATUS_LINES = 2
+
+
+def move_to(row, col):
+    # ANSI rows and columns start at 1
+    return '\x1b[%d;%dH' % (row + 1, col + 1)
+
+
+class TerminalRenderer(object):
+    # live view of a TDGame: the last drawn frame is kept as a {(x, y): text}
+    # buffer and only the cells with bugs or towers, now or on the last frame,
+    # are redrawn when their text changed; draws every `every` frames and only
+    # the viewport (x, y, width, height), by default what fits the terminal
+    def __init__(self, game, f_out=sys.stdout, every=1, viewport=None,
+                 cell_width=3):
+        self.game = game
+        self.f_out = f_out
+        self.every = every
+        self.cell_width = cell_width
+        self.viewport = viewport
+        self.buffer = {}
+        # cells that showed a bug or a tower on the last drawn frame
+        self.overlay = set()
+        self.status = None
+        self.full_redraw = True
+
+    def default_viewport(self):
+        size = shutil.get_terminal_size()
+        width = max(size.columns // (self.cell_width + 1), 1)
+        height = max(size.lines - STATUS_LINES - 1, 1)
+        return (0, 0, width, height)
+
+    def set_viewport(self, x, y, width, height):
+        self.viewport = (x, y, width, height)
+        self.full_redraw = True
+
+    def scroll(self, dx, dy):
+        x, y, width, height = self.viewport or self.default_viewport()
+        self.set_viewport(max(x + dx, 0), max(y + dy, 0), width, height)
+
+    def render(self, force=False):
+        game = self.game
+        if not force and self.every > 1 and game.frame % self.every:
+            return
+        if self.viewport is None:
+            self.viewport = self.default_viewport()
+        out = []
+        if self.full_redraw:
+            out.append(HIDE_CURSOR + CLEAR_SCREEN)
+            self.buffer = {}
+            self.status = None
+            cells = self.viewport_cells()
+        else:
+            cells = None
+
+        overlay = self.overlay_texts()
+        if cells is None:
+            cells = self.overlay | set(overlay)
+        x0, y0, width, height = self.viewport
+        for (x, y) in cells:
+            if not (x0 <= x < x0 + width and y0 <= y < y0 + height):
+                continue
+            text = overlay.get((x, y))
+            if text is None:
+                text = self.game.map.get_pos_value(x, y) or ''
+            text = text[:self.cell_width].ljust(self.cell_width)
+            if self.buffer.get((x, y)) == text:
+                continue
+            self.buffer[(x, y)] = text
+            out.append(move_to(y - y0, (x - x0) * (self.cell_width + 1)))
+            out.append(text)
+        self.overlay = set(overlay)
+        self.full_redraw = False
+
+        status = ['Frame: %s  Life: %s  Money: %s' % (
+                      game.frame, game.life, game.money),
+                  'Bugs: %s  Towers: %s' % (len(game.bugs), len(game.towers))]
+        if status != self.status:
+            for i, line in enumerate(status):
+                out.append(move_to(height + i, 0) + '\x1b[2K' + line)
+            self.status = status
+        out.append(move_to(height + STATUS_LINES, 0))
+        self.f_out.write(''.join(out))
+        self.f_out.flush()
+
+    def close(self):
+        self.f_out.write(SHOW_CURSOR + '\n')
+        self.f_out.flush()
+
+    def viewport_cells(self):
+        x0, y0, width, height = self.viewport
+        rows = self.game.map.rows
+        return [(x, y)
+                for y in range(y0, min(y0 + height, len(rows)))
+                for x in range(x0, min(x0 + width, len(rows[y])))]
+
+    def overlay_texts(self):
+        texts = {}
+        for tower in self.game.towers.values():
+            texts[(tower.position.x, tower.position.y)] = tower.id
+        # bugs are drawn over towers, like in Map.show
+        for pos, bugs in self.bug_cells().items():
+            texts[pos] = self.game.map.show_bugs(bugs)
+        return texts
+
+    def bug_cells(self):
+        cells = {}
+        bugs = self.game.bugs
+        road = self.game.map.bug_road
+        if self.game.vectorized:
+            # read the offsets of the bugs on the map straight from the store
+            for i in np.flatnonzero(bugs.alive & (bugs.offset >= 0)):
+                pos = road[bugs.offset[i]]
+                cells.setdefault((pos.x, pos.y), []).append(BugView(bugs, i))
+            return cells
+        for bug in bugs.values():
+            pos = bug.position
+            if pos is None:
+                continue
+            cells.setdefault((pos.x, pos.y), []).append(bug)
+        return cells
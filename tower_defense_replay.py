@@ -0,0 +1,322 @@
+import argparse
+import bisect
+import json
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from tower_defense import Action, Position, TDGame
+
+# Replay log: one JSON object per line, appended while the game runs
+#   header:   {"version": 1, "keyframe_every": K, "road": [[x, y], ...]}
+#   delta:    {"frame": f, "life": l, "money": m, "spawned": [bug ids],
+#              "shots": [[tower, bug]], "damage": {bug: {color: health}},
+#              "cleared": [bug ids], "towers": {tower: [x, y, colors]},
+#              "errors": [messages]}
+#   keyframe: {"frame": f, "keyframe": {"life": l, "money": m,
+#              "bugs": {bug: [offset, colors]}, "towers": {...}}}
+# A keyframe holds the state after the delta of the same frame; one is written
+# when the recording starts and then every K frames. Moves are not listed:
+# every bug on the map walks one cell per frame until the end of the road.
+# The byte offsets of the keyframes are saved to <log>.idx on close.
+VERSION = 1
+
+
+def bug_states(game):
+    # {bug_id: [offset, colors]} of the bugs that were not cleared
+    bugs = game.bugs
+    if game.vectorized:
+        states = {}
+        for i in np.flatnonzero(bugs.alive):
+            offset = int(bugs.offset[i])
+            states[bugs.ids[i]] = [offset if offset >= 0 else None,
+                                   bugs.bug_colors(i)]
+        return states
+    return dict((bug.id, [bug.offset, dict(bug.colors)])
+                for bug in bugs.values())
+
+
+def tower_states(towers):
+    return dict((tower.id, [tower.position.x, tower.position.y,
+                            dict(tower.colors)])
+                for tower in towers)
+
+
+class ReplayRecorder(object):
+    # writes the replay log of a TDGame as it is played; set it as
+    # game.recorder before start_simulation. The game should only go forward,
+    # a restored game is not followed.
+    def __init__(self, game, path, keyframe_every=100):
+        self.game = game
+        self.path = path
+        self.keyframe_every = keyframe_every
+        self.f_out = None
+        self.pos = 0
+        self.keyframes = []
+        self.last_frame = None
+        if getattr(game, 'simulation_started', False):
+            self.start()
+
+    def start(self):
+        if self.f_out is not None:
+            return
+        game = self.game
+        self.f_out = open(self.path, 'wb')
+        self._write({'version': VERSION, 'keyframe_every': self.keyframe_every,
+                     'road': [[pos.x, pos.y] for pos in game.map.bug_road]})
+        self.towers = set(game.towers)
+        self.nr_errors = len(game.errors)
+        if game.vectorized:
+            self.health = game.bugs.health.copy()
+            self.alive = game.bugs.alive.copy()
+        else:
+            self.colors = dict((bug.id, dict(bug.colors))
+                               for bug in game.bugs.values())
+        self._write_keyframe()
+
+    def record(self, actions):
+        if self.f_out is None:
+            raise Exception('The recorder was not started')
+        game = self.game
+        delta = {'frame': game.frame, 'life': game.life, 'money': game.money}
+        if game.vectorized:
+            delta.update(self._bug_changes_vectorized())
+        else:
+            delta.update(self._bug_changes())
+        delta['shots'] = [[action.tower_id, action.bug_id]
+                          for action in actions or ()
+                          if action.action_type == Action.SHOOT]
+        delta['towers'] = tower_states(game.towers[tower_id]
+                                       for tower_id in game.towers
+                                       if tower_id not in self.towers)
+        self.towers.update(delta['towers'])
+        delta['errors'] = game.errors[self.nr_errors:]
+        self.nr_errors = len(game.errors)
+        self._write(delta)
+        self.last_frame = game.frame
+        if game.frame % self.keyframe_every == 0:
+            self._write_keyframe()
+
+    def _bug_changes(self):
+        game = self.game
+        bugs = game.bugs
+        colors = self.colors
+        spawned = [bug_id for bug_id in game.spawns.get(game.frame, ())
+                   if bug_id in colors]
+        cleared = [bug_id for bug_id in colors if bug_id not in bugs]
+        damage = {}
+        for bug in bugs.values():
+            if bug.colors != colors[bug.id]:
+                damage[bug.id] = colors[bug.id] = dict(bug.colors)
+        for bug_id in cleared:
+            del colors[bug_id]
+        return {'spawned': spawned, 'damage': damage, 'cleared': cleared}
+
+    def _bug_changes_vectorized(self):
+        game = self.game
+        bugs = game.bugs
+        ids = bugs.ids
+        spawned = [bug_id for bug_id in game.spawns.get(game.frame, ())
+                   if self.alive[bugs.index[bug_id]]]
+        cleared = [ids[i] for i in np.flatnonzero(self.alive & ~bugs.alive)]
+        changed = bugs.alive & np.any(bugs.health != self.health, axis=1)
+        damage = {}
+        for i in np.flatnonzero(changed):
+            damage[ids[i]] = bugs.bug_colors(i)
+        self.health[changed] = bugs.health[changed]
+        self.alive[...] = bugs.alive
+        return {'spawned': spawned, 'damage': damage, 'cleared': cleared}
+
+    def _write_keyframe(self):
+        game = self.game
+        self.keyframes.append((game.frame, self.pos))
+        self._write({'frame': game.frame,
+                     'keyframe': {'life': game.life, 'money': game.money,
+                                  'bugs': bug_states(game),
+                                  'towers': tower_states(game.towers.values())}})
+
+    def _write(self, record):
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        self.f_out.write(line)
+        self.pos += len(line)
+
+    def close(self):
+        if self.f_out is None:
+            return
+        self.f_out.close()
+        self.f_out = None
+        with open(self.path + '.idx', 'w') as f_index:
+            json.dump({'keyframes': self.keyframes,
+                       'last_frame': self.last_frame}, f_index)
+
+
+class ReplayState(object):
+    # the game as seen by the replay after `frame`
+    def __init__(self, frame, life, money, bugs, towers, road):
+        self.frame = frame
+        self.life = life
+        self.money = money
+        # {bug_id: [offset, colors]}, offset is None before the bug spawns
+        self.bugs = bugs
+        # {tower_id: [x, y, colors]}
+        self.towers = towers
+        self.road = road
+        # what happened on this frame, empty after a seek to a keyframe
+        self.shots = []
+        self.errors = []
+
+    def position(self, bug_id):
+        offset = self.bugs[bug_id][0]
+        if offset is None:
+            return None
+        return self.road[offset]
+
+    def apply(self, delta):
+        last = len(self.road) - 1
+        bugs = self.bugs
+        for bug in bugs.values():
+            if bug[0] is not None and bug[0] < last:
+                bug[0] += 1
+        for bug_id in delta['spawned']:
+            bugs[bug_id][0] = 0
+        for bug_id, colors in delta['damage'].items():
+            bugs[bug_id][1] = colors
+        for bug_id in delta['cleared']:
+            del bugs[bug_id]
+        self.towers.update(delta['towers'])
+        self.frame = delta['frame']
+        self.life = delta['life']
+        self.money = delta['money']
+        self.shots = delta['shots']
+        self.errors = delta['errors']
+
+    def __str__(self):
+        return 'frame %s - life %s - money %s - bugs %s - towers %s' % (
+            self.frame, self.life, self.money, len(self.bugs), len(self.towers))
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class Replay(object):
+    # random access to a replay log: seek loads the closest keyframe and
+    # plays at most K deltas on top of it
+    def __init__(self, path):
+        self.f_in = open(path, 'rb')
+        header = json.loads(self.f_in.readline().decode('utf-8'))
+        if header.get('version') != VERSION:
+            raise Exception('Unsupported replay version %s' % (header.get('version'), ))
+        self.keyframe_every = header['keyframe_every']
+        self.road = [Position(x, y) for x, y in header['road']]
+        if os.path.exists(path + '.idx'):
+            with open(path + '.idx') as f_index:
+                index = json.load(f_index)
+            self.keyframes = [tuple(keyframe) for keyframe in index['keyframes']]
+            self.last_frame = index['last_frame']
+        else:
+            # the game did not close the recorder
+            self._scan()
+        self.keyframe_frames = [frame for frame, pos in self.keyframes]
+        self.first_frame = self.keyframe_frames[0]
+        self.state = None
+        # file offset of the line after the current state
+        self.pos = None
+        self.seek(self.first_frame)
+
+    def _scan(self):
+        self.keyframes = []
+        self.last_frame = None
+        pos = self.f_in.tell()
+        for line in self.f_in:
+            record = json.loads(line.decode('utf-8'))
+            if 'keyframe' in record:
+                self.keyframes.append((record['frame'], pos))
+            else:
+                self.last_frame = record['frame']
+            pos += len(line)
+
+    def seek(self, frame):
+        if frame < self.first_frame or frame > self.last_frame:
+            raise Exception('Frame %s is not in the replay (%s - %s)' % (
+                frame, self.first_frame, self.last_frame))
+        i = bisect.bisect_right(self.keyframe_frames, frame) - 1
+        key_frame, pos = self.keyframes[i]
+        self.f_in.seek(pos)
+        keyframe = json.loads(self.f_in.readline().decode('utf-8'))['keyframe']
+        self.state = ReplayState(key_frame, keyframe['life'], keyframe['money'],
+                                 keyframe['bugs'], keyframe['towers'],
+                                 self.road)
+        self.pos = self.f_in.tell()
+        while self.state.frame < frame:
+            self.step()
+        return self.state
+
+    def step(self):
+        # forward one frame, None at the end of the log
+        if self.state.frame >= self.last_frame:
+            return None
+        self.f_in.seek(self.pos)
+        while True:
+            line = self.f_in.readline()
+            if not line:
+                return None
+            record = json.loads(line.decode('utf-8'))
+            if 'keyframe' not in record:
+                break
+        self.state.apply(record)
+        self.pos = self.f_in.tell()
+        return self.state
+
+    def back(self):
+        # back one frame, None at the start of the log
+        if self.state.frame <= self.first_frame:
+            return None
+        return self.seek(self.state.frame - 1)
+
+    def close(self):
+        self.f_in.close()
+
+
+def record_game(level_path, actions_path, log_path, keyframe_every=100,
+                vectorized=False):
+    game = TDGame(verbose=False, vectorized=vectorized)
+    with open(level_path) as f_in, open(actions_path) as f_actions:
+        game.initialize(f_in, f_actions)
+    game.recorder = ReplayRecorder(game, log_path, keyframe_every)
+    try:
+        return game.run_to_completion()
+    finally:
+        game.recorder.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record or inspect TD Game replays.')
+    commands = parser.add_subparsers(dest='command')
+    record = commands.add_parser('record', help='play a solution and log it')
+    record.add_argument('level')
+    record.add_argument('solution')
+    record.add_argument('log')
+    record.add_argument('--keyframe-every', type=int, default=100)
+    record.add_argument('--vectorized', action='store_true')
+    show = commands.add_parser('show', help='print the state after a frame')
+    show.add_argument('log')
+    show.add_argument('frame', type=int)
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        print(record_game(args.level, args.solution, args.log,
+                          args.keyframe_every, args.vectorized))
+    elif args.command == 'show':
+        replay = Replay(args.log)
+        state = replay.seek(args.frame)
+        print(state)
+        for bug_id, (offset, colors) in sorted(state.bugs.items()):
+            print('%s %s %s' % (bug_id, state.position(bug_id), colors))
+        for error in state.errors:
+            print('ERROR: ' + error)
+        replay.close()
+    else:
+        parser.print_help()
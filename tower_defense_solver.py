@@ -0,0 +1,290 @@
+import argparse
+import multiprocessing
+
+from tower_defense import Action, GameLost, Position, TDGame, Tower
+from tower_defense_targeting import POLICIES, Targeting
+
+
+class Node(object):
+    # one state of the beam: the game snapshot after playing `actions` on
+    # top of the parent's state
+    def __init__(self, snapshot, parent, actions, value, score,
+                 finished=False, affordable=True):
+        self.snapshot = snapshot
+        self.parent = parent
+        self.actions = actions
+        # value orders the beam, score ranks the final plans
+        self.value = value
+        self.score = score
+        self.finished = finished
+        # the towers left to build can still be paid for
+        self.affordable = affordable
+
+    def history(self):
+        actions = []
+        node = self
+        while node:
+            actions.extend(reversed(node.actions))
+            node = node.parent
+        actions.reverse()
+        return actions
+
+
+def score(game):
+    # the score of a valid finished game
+    return game.life + game.money
+
+
+def evaluate(game):
+    # bugs still on the road will hit us with their remaining health
+    pending = 0
+    for bug in game.bugs.values():
+        if bug.offset is not None:
+            pending += sum(val for val in bug.colors.values() if val > 0)
+    return (game.life - pending, game.money)
+
+
+def dominates(node, other):
+    # at least as much life, money and towers as the other node and more of
+    # one of them
+    mine = node.value + (len(node.snapshot.towers), )
+    theirs = other.value + (len(other.snapshot.towers), )
+    return mine != theirs and all(a >= b for a, b in zip(mine, theirs))
+
+
+def rank_tower_cells(game):
+    # free cells ordered by how much of the bug road they cover
+    tower_range = game.settings.get('tower_range')
+    cells = []
+    for y, row in enumerate(game.map.rows):
+        for x, val in enumerate(row):
+            if (x, y) in game.map.road_offsets:
+                continue
+            tower = Tower(None)
+            tower.position = Position(x, y)
+            tower.cover_road(game.map.road_offsets, tower_range)
+            if tower.road_offsets:
+                # prefer the cells closer to the exit on equal coverage
+                cells.append((len(tower.road_offsets),
+                              tower.road_offsets[-1], (x, y)))
+    cells.sort(reverse=True)
+    return [cell for (coverage, last, cell) in cells]
+
+
+def level_colors(game):
+    colors = set()
+    for bug in game.bugs.values():
+        colors.update(bug.colors)
+    return sorted(colors)
+
+
+class BeamSearch(object):
+    def __init__(self, game, placements, tower_colors, beam_width=8,
+                 life_margin=None, max_frames=None, policies=None):
+        self.game = game
+        # cells to build on, in order, and the colors of each new tower
+        self.placements = placements
+        self.tower_colors = tower_colors
+        self.beam_width = beam_width
+        # prune the states whose life is this far behind the best one
+        self.life_margin = life_margin
+        self.max_frames = max_frames
+        if policies is None:
+            policies = [POLICIES[name] for name in sorted(POLICIES)]
+        # the shots of every policy are chosen by its Targeting while the
+        # frame is played
+        self.targetings = [Targeting(game, policy, keep=True)
+                           for policy in policies]
+
+    def run(self):
+        game = self.game
+        game.start_simulation()
+        beam = [Node(game.snapshot(), None, [], evaluate(game), score(game))]
+        finished = []
+        while beam:
+            if self.max_frames is not None and game.frame + 1 >= self.max_frames:
+                finished.extend(beam)
+                break
+            children = []
+            for node in beam:
+                children.extend(self.expand(node))
+            finished.extend(child for child in children if child.finished)
+            beam = self.prune([child for child in children
+                               if not child.finished])
+        if not finished:
+            return None
+        return max(finished, key=lambda node: (node.finished, node.score))
+
+    def expand(self, node):
+        game = self.game
+        game.restore(node.snapshot)
+        frame = game.frame + 1
+        seen = set()
+        builds = self.next_builds(node.snapshot, frame)
+        children = []
+        for actions in ([], builds):
+            if actions is builds and not builds:
+                continue
+            for targeting in self.targetings:
+                game.restore(node.snapshot)
+                try:
+                    won = self.play(actions, frame, targeting)
+                except GameLost:
+                    continue
+                frame_actions = actions + targeting.actions
+                key = tuple(sorted((a.action_type, tuple(sorted(a.attrs.items())))
+                                   for a in frame_actions))
+                if key in seen:
+                    continue
+                seen.add(key)
+                if len(game.errors) > node.snapshot.nr_errors:
+                    # only valid plans are kept
+                    continue
+                finished = won or game._is_out_of_bugs()
+                children.append(Node(game.snapshot(), node, frame_actions,
+                                     evaluate(game), score(game), finished,
+                                     self.affordable(game)))
+        return children
+
+    def affordable(self, game):
+        # the money and the rewards of the bugs left cover the towers that
+        # are still to build
+        missing = len(self.placements) - len(game.towers)
+        if missing <= 0:
+            return True
+        budget = (game.money +
+                  game.settings.get('reward_per_bug') * len(game.bugs))
+        return budget >= missing * game.settings.get('tower_cost')
+
+    def play(self, actions, frame, targeting=None):
+        # the engine rules do the work, we only schedule the frame; the
+        # shots the targeting adds are left in targeting.actions
+        game = self.game
+        game.frames[frame] = actions
+        game.targeting = targeting
+        if targeting is not None:
+            targeting.actions = []
+        try:
+            return game.next_step()
+        finally:
+            game.frames.pop(frame, None)
+            game.targeting = None
+
+    def next_builds(self, snapshot, frame):
+        built = len(snapshot.towers)
+        if built >= len(self.placements):
+            return []
+        if snapshot.money < self.game.settings.get('tower_cost'):
+            return []
+        colors = self.tower_colors[built % len(self.tower_colors)]
+        return [Action.new_tower(frame, 'T%s' % (built + 1, ),
+                                 self.placements[built], colors)]
+
+    def prune(self, nodes):
+        # the states that can not build their towers any more are only kept
+        # when there is nothing else
+        nodes = [node for node in nodes if node.affordable] or nodes
+        nodes.sort(key=lambda node: node.value, reverse=True)
+        if self.life_margin is not None and nodes:
+            best_life = nodes[0].value[0]
+            nodes = [node for node in nodes
+                     if node.value[0] >= best_life - self.life_margin]
+        # all the nodes are on the same frame, a state dominated by a kept
+        # one on life, money and towers is not expected to do better
+        kept = []
+        for node in nodes:
+            if any(dominates(other, node) for other in kept):
+                continue
+            kept.append(node)
+            if len(kept) == self.beam_width:
+                break
+        return kept
+
+
+_level = None
+
+
+def _init_worker(level):
+    # the level is parsed once by the parent and inherited by the workers
+    global _level
+    _level = level
+
+
+def load_game(level):
+    game = TDGame(verbose=False)
+    game.initialize_level(level)
+    return game
+
+
+def search_branch(args):
+    # one branch of the search: a number of towers to place, the offset into
+    # the ranked cells to place them from and the power of their single color
+    nr_towers, skip, power, beam_width, life_margin, max_frames = args
+    game = load_game(_level)
+    cells = rank_tower_cells(game)
+    placements = cells[skip:skip + nr_towers]
+    colors = [{color: power} for color in level_colors(game)]
+    search = BeamSearch(game, placements, colors, beam_width=beam_width,
+                        life_margin=life_margin, max_frames=max_frames)
+    best = search.run()
+    if best is None:
+        return None
+    return (best.finished, best.score, best.history())
+
+
+def branches(level, max_towers, powers, beam_width, life_margin,
+             max_frames):
+    game = load_game(level)
+    cells = rank_tower_cells(game)
+    max_towers = min(max_towers, len(cells))
+    return [(nr_towers, skip, power, beam_width, life_margin, max_frames)
+            for nr_towers in range(1, max_towers + 1)
+            for skip in range(0, min(3, len(cells) - nr_towers + 1))
+            for power in powers]
+
+
+def solve(level_path, f_solution=None, max_towers=10, powers=(1, 2, 4),
+          beam_width=8, life_margin=None, max_frames=None, processes=None):
+    with open(level_path) as f_in:
+        level = TDGame().read_level(f_in)
+    tasks = branches(level, max_towers, powers, beam_width, life_margin,
+                     max_frames)
+    pool = multiprocessing.Pool(processes, _init_worker, (level,))
+    try:
+        results = [result for result in pool.map(search_branch, tasks)
+                   if result]
+    finally:
+        pool.close()
+        pool.join()
+    if not results:
+        return None
+    finished, best_score, actions = max(results,
+                                        key=lambda result: result[:2])
+
+    if f_solution:
+        game = TDGame(verbose=False)
+        game.actions = actions
+        game.dump_actions(f_solution)
+    return best_score, actions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search a TD Game solution.')
+    parser.add_argument('level')
+    parser.add_argument('solution')
+    parser.add_argument('--max-towers', type=int, default=10)
+    parser.add_argument('--beam-width', type=int, default=8)
+    parser.add_argument('--life-margin', type=int, default=None)
+    parser.add_argument('--max-frames', type=int, default=None)
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    with open(args.solution, 'w') as f_solution:
+        result = solve(args.level, f_solution, args.max_towers,
+                       beam_width=args.beam_width,
+                       life_margin=args.life_margin,
+                       max_frames=args.max_frames, processes=args.processes)
+    if result is None:
+        print('No valid solution found')
+    else:
+        print('Score: %s - %s actions' % (result[0], len(result[1])))
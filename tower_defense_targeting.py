@@ -0,0 +1,236 @@
+import argparse
+import io
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from tower_defense import Action, TDGame
+
+
+# targeting keys over the (tower, bug) pairs in range, every tower shoots
+# the bug with the highest key; offset is the road offset of the bug, health
+# its remaining health and useful the damage of the shot that does not turn
+# into collateral damage
+def closest_to_exit(offset, health, useful):
+    return offset
+
+
+def lowest_health(offset, health, useful):
+    return -health
+
+
+def most_damage(offset, health, useful):
+    # closest to the exit on equal damage
+    return useful * (int(offset.max()) + 1) + offset
+
+
+POLICIES = {
+    'closest_to_exit': closest_to_exit,
+    'lowest_health': lowest_health,
+    'most_damage': most_damage,
+}
+
+
+class Targeting(object):
+    # shoots for the towers of a TDGame; set it as game.targeting and every
+    # frame each tower without a shoot action gets the bug chosen by the
+    # policy. All the towers pick at once over the (tower, bug) pairs in
+    # range; when towers pick the same bug the first one shoots it and the
+    # others pick again with its health updated, so no shot is wasted on a
+    # bug that is already dead. Only the shots with useful damage are made.
+    # With keep the shots are saved in self.actions, for a game that only
+    # goes forward.
+    def __init__(self, game, policy=closest_to_exit, keep=False):
+        if np is None:
+            raise Exception('numpy is required for the targeting')
+        self.game = game
+        self.policy = policy
+        self.keep = keep
+        self.actions = []
+        self.colors = sorted(set(color for bug in game.level.bugs
+                                 for color in bug.colors))
+        self.color_index = dict((c, i) for i, c in enumerate(self.colors))
+        # tower tables, built again when the towers change
+        self.towers = []
+
+    def _build_tables(self, towers):
+        self.towers = towers
+        self.tower_ids = [tower.id for tower in towers]
+        self.tower_rows = dict((tower_id, t)
+                               for t, tower_id in enumerate(self.tower_ids))
+        self.damage = np.zeros((len(towers), len(self.colors)), dtype=np.int64)
+        # a tower shooting a color the bugs do not have is not used
+        self.usable = np.ones(len(towers), dtype=bool)
+        tower_index = []
+        offsets = []
+        for t, tower in enumerate(towers):
+            for color, value in tower.colors.items():
+                if color not in self.color_index:
+                    self.usable[t] = False
+                    continue
+                self.damage[t, self.color_index[color]] = value
+            tower_index.extend([t] * len(tower.road_offsets))
+            offsets.extend(tower.road_offsets)
+        # (tower, covered offset) pairs
+        self.pair_towers = np.array(tower_index, dtype=np.int64)
+        self.pair_offsets = np.array(offsets, dtype=np.int64)
+        self.needs = self.damage != 0
+
+    def _bugs_on_map(self):
+        # ids, offsets, health and which colors every bug has; the ids are
+        # the rows of the store in the vectorized game
+        game = self.game
+        if game.vectorized:
+            store = game.bugs
+            rows = np.arange(store.lo, store.hi)
+            rows = rows[store.alive[rows] & (store.offset[rows] >= 0)]
+            return rows, store.offset[rows], store.health[rows], store.present[rows]
+        bugs = [bug for bug in game.active.values() if bug.offset is not None]
+        ids = [bug.id for bug in bugs]
+        offsets = np.array([bug.offset for bug in bugs], dtype=np.int64)
+        health = np.zeros((len(bugs), len(self.colors)), dtype=np.int64)
+        has = np.zeros(health.shape, dtype=bool)
+        color_index = self.color_index
+        for i, bug in enumerate(bugs):
+            for color, value in bug.colors.items():
+                health[i, color_index[color]] = value
+                has[i, color_index[color]] = True
+        return ids, offsets, health, has
+
+    def shots(self, actions):
+        # the shoot actions of the current frame, after the bugs moved
+        game = self.game
+        if not game.towers:
+            return []
+        # towers are only added and a restored game has other tower objects,
+        # so the count and the last tower tell if the tables are up to date
+        last = self.towers[-1] if self.towers else None
+        if (len(self.towers) != len(game.towers) or
+                last is not game.towers.get(last.id)):
+            self._build_tables(list(game.towers.values()))
+        ids, offsets, health, has = self._bugs_on_map()
+        if not len(ids):
+            return []
+        health = health.copy()
+        free = self.usable.copy()
+        # the towers with a shoot action keep it
+        shoot_actions = [action for action in actions or ()
+                         if action.action_type == Action.SHOOT]
+        if shoot_actions:
+            if game.vectorized:
+                bug_rows = dict((game.bugs.ids[i], b) for b, i in enumerate(ids))
+            else:
+                bug_rows = dict((bug_id, b) for b, bug_id in enumerate(ids))
+        for action in shoot_actions:
+            t = self.tower_rows.get(action.tower_id)
+            if t is None:
+                continue
+            free[t] = False
+            b = bug_rows.get(action.bug_id)
+            if b is not None:
+                health[b] -= self.damage[t]
+
+        # (tower, bug) pairs in range: the bugs are grouped by offset and
+        # every covered offset of a tower brings its group
+        order = np.argsort(offsets, kind='stable')
+        sorted_offsets = offsets[order]
+        starts = np.searchsorted(sorted_offsets, self.pair_offsets)
+        counts = np.searchsorted(sorted_offsets, self.pair_offsets,
+                                 side='right') - starts
+        keep = free[self.pair_towers] & (counts > 0)
+        starts, counts = starts[keep], counts[keep]
+        towers_in_range = np.repeat(self.pair_towers[keep], counts)
+        first = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        bugs_in_range = order[first + np.arange(len(towers_in_range))]
+        # the tower needs all its colors on the bug
+        valid = ~np.any(self.needs[towers_in_range] & ~has[bugs_in_range], axis=1)
+        pair_t = towers_in_range[valid]
+        pair_b = bugs_in_range[valid]
+
+        planned = []
+        while len(pair_t):
+            damage = self.damage[pair_t]
+            left = np.clip(health[pair_b], 0, None)
+            useful = (np.minimum(damage, left) -
+                      np.maximum(damage - left, 0)).sum(axis=1)
+            shoot = useful > 0
+            pair_t, pair_b, useful = pair_t[shoot], pair_b[shoot], useful[shoot]
+            if not len(pair_t):
+                break
+            key = self.policy(offsets[pair_b], left[shoot].sum(axis=1), useful)
+            # the best bug of every tower, the first bug on equal keys
+            best = np.lexsort((-pair_b, key, pair_t))
+            last = np.flatnonzero(np.append(pair_t[best][1:] != pair_t[best][:-1],
+                                            True))
+            chosen_t = pair_t[best[last]]
+            chosen_b = pair_b[best[last]]
+            # the first tower that picked a bug shoots it
+            targets, winners = np.unique(chosen_b, return_index=True)
+            shooters = chosen_t[winners]
+            health[targets] -= self.damage[shooters]
+            planned.extend(zip(shooters.tolist(), targets.tolist()))
+            # the other towers pick again
+            again = np.ones(len(self.tower_ids), dtype=bool)
+            again[shooters] = False
+            pick = again[pair_t]
+            pair_t, pair_b = pair_t[pick], pair_b[pick]
+
+        planned.sort()
+        if game.vectorized:
+            planned = [(t, int(ids[b])) for t, b in planned]
+            ids = game.bugs.ids
+        shots = [Action.shoot(game.frame, self.tower_ids[t], ids[b])
+                 for t, b in planned]
+        if self.keep:
+            self.actions.extend(shots)
+        return shots
+
+    def target(self, actions):
+        # the actions of the frame with the shots of the policy added
+        shots = self.shots(actions)
+        if not shots:
+            return actions
+        return list(actions or ()) + shots
+
+
+def play(level_path, actions_path=None, policy=closest_to_exit,
+         vectorized=False, max_frames=None, f_solution=None):
+    # plays the builds of a solution with the shots chosen by the policy;
+    # with f_solution the whole solution is written there
+    game = TDGame(verbose=False, vectorized=vectorized)
+    with open(level_path) as f_in:
+        if actions_path:
+            with open(actions_path) as f_actions:
+                game.initialize(f_in, f_actions)
+        else:
+            game.initialize(f_in)
+    game.targeting = Targeting(game, policy, keep=f_solution is not None)
+    result = game.run_to_completion(max_frames=max_frames)
+    if f_solution is not None:
+        game.actions = sorted(game.actions + game.targeting.actions,
+                              key=lambda action: action.frame)
+        game.dump_actions(f_solution)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Play a TD Game level with automatic targeting.')
+    parser.add_argument('level')
+    parser.add_argument('solution', nargs='?',
+                        help='the towers to build, the shots are added')
+    parser.add_argument('--policy', choices=sorted(POLICIES),
+                        default='closest_to_exit')
+    parser.add_argument('--vectorized', action='store_true')
+    parser.add_argument('--max-frames', type=int, default=None)
+    parser.add_argument('--save', help='write the whole solution here')
+    args = parser.parse_args()
+
+    f_solution = io.StringIO() if args.save else None
+    print(play(args.level, args.solution, POLICIES[args.policy],
+               args.vectorized, args.max_frames, f_solution))
+    if args.save:
+        with open(args.save, 'w') as f_save:
+            f_save.write(f_solution.getvalue())